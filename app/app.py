@@ -1,8 +1,8 @@
 import streamlit as st
 import uuid
 import time
-from assistant import get_answer
-from db import save_conversation, save_feedback, get_recent_conversations, get_feedback_stats
+from assistant import get_answer_stream_async, get_query_cache_stats, iterate_sync, startup_report
+from db import save_feedback, get_recent_conversations, get_feedback_stats, get_pool_stats
 
 def print_log(message):
     print(message, flush=True)
@@ -13,6 +13,7 @@ def main():
     if 'conversation_id' not in st.session_state:
         st.session_state.conversation_id = str(uuid.uuid4())
         print_log(f"New conversation started with ID: {st.session_state.conversation_id}")
+        print_log(f"Startup: {startup_report()}")
     if 'count' not in st.session_state:
         st.session_state.count = 0
         print_log("Feedback count initialized to 0")
@@ -27,7 +28,7 @@ def main():
     # Search type choice
     search_type = st.radio(
         "Select search type:",
-        ["Text", "Vector"]
+        ["Text", "Vector", "Hybrid"]
     )
     print_log(f"User selected search type: {search_type}")
 
@@ -35,25 +36,45 @@ def main():
     user_input = st.text_input("Enter your query. (Hint: What do you feel like eating? What ingredients do you have? How much time do you have?)")
     if st.button("Ask"):
         print_log(f"User asked: '{user_input}'")
+        # Every answer is its own conversation row, relevance update, trace
+        # and feedback target, so each Ask gets a fresh id.
+        st.session_state.conversation_id = str(uuid.uuid4())
+        print_log(f"Answer conversation ID: {st.session_state.conversation_id}")
         start_time = time.time()
-        answer_data = get_answer(user_input, model_choice, search_type)
+        # Runs on the assistant's event loop, which also saves the answer and
+        # evaluates its relevance in the background once the stream ends.
+        answer_stream, answer_data = get_answer_stream_async(
+            user_input, model_choice, search_type, conversation_id=st.session_state.conversation_id
+        )
+        st.write_stream(iterate_sync(answer_stream))
         end_time = time.time()
         print_log(f"Answer received in {end_time - start_time:.2f} seconds")
+        print_log(f"Query embedding cache: {get_query_cache_stats()}")
         st.success("Completed!")
-        st.write(answer_data['answer'])
 
     # Monitering information
+        st.write(f"Time to first token: {answer_data['time_to_first_token']:.2f} seconds")
         st.write(f"Response time: {answer_data['response_time']:.2f} seconds")
-        st.write(f"Relevance: {answer_data['relevance']}")
+        st.write(f"Retrieval time: {answer_data['retrieval_time'] * 1000:.0f} ms")
+        if answer_data['search_latency']:
+            legs = ", ".join(f"{leg}: {ms:.0f} ms" for leg, ms in answer_data['search_latency'].items())
+            st.write(f"Search latency: {legs}")
+        if answer_data['relevance'] == 'PENDING':
+            st.write("Relevance: PENDING (evaluation running in the background)")
+        else:
+            st.write(f"Relevance: {answer_data['relevance']}")
         st.write(f"Model used: {answer_data['model_used']}")
+        if answer_data['model_used'] != answer_data['requested_model']:
+            st.write(f"{answer_data['requested_model']} was unavailable ({answer_data['llm_error']}), answered by the fallback model")
         st.write(f"Total tokens: {answer_data['total_tokens']}")
+        if answer_data['context_tokens_saved'] > 0:
+            st.write(f"Prompt tokens saved by context budgeting: {answer_data['context_tokens_saved']}")
         if answer_data['openai_cost'] > 0:
             st.write(f"OpenAI cost: ${answer_data['openai_cost']:.4f}")
+        if answer_data['cache_hit']:
+            st.write(f"Served from semantic cache, saved ${answer_data['cache_saved_cost']:.4f} and {answer_data['cache_saved_tokens']} tokens")
 
-        # Save conversation to database
-        print_log("Saving conversation to database")
-        save_conversation(st.session_state.conversation_id, user_input, answer_data)
-        print_log("Conversation saved successfully")
+        print_log(f"Database pool: {get_pool_stats()}")
 
     # Feedback buttons
     col1, col2 = st.columns(2)
@@ -74,7 +95,7 @@ def main():
 
     # Displaying conversation history
     st.subheader("Recent Conversations")
-    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"])
+    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "PENDING"])
     recent_conversations = get_recent_conversations(limit=5, relevance=relevance_filter if relevance_filter != "All" else None)
     for conv in recent_conversations:
         st.write(f"Q: {conv['question']}")
@@ -1,8 +1,19 @@
-from openai import OpenAI
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+from startup import Lazy, mark_imported, startup_report
+from openai import AsyncOpenAI
+from elasticsearch import AsyncElasticsearch
 from dotenv import load_dotenv
+from cache import TTLCache
+from semantic_cache import SemanticCache
+from db import update_relevance, save_conversation
+from constraints import parse_constraints, build_es_filters
+from vector_index import VectorIndex
+from ingredient_index import IngredientIndex
+from llm_router import LLMRouter
+from recipe_loader import parse_list
+from tracing import activate, finishing, span, start_trace, timed, trace
+import asyncio
 import json
+import threading
 import time
 import os
 
@@ -12,17 +23,153 @@ ELASTIC_URL = os.getenv('ELASTIC_URL')
 OLLAMA_URL = os.getenv('OLLAMA_URL')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 MODEL_NAME = os.getenv('MODEL_NAME')
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '4096'))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '3600'))
+EMBED_QUANTIZE = os.getenv('EMBED_QUANTIZE', 'false').lower() == 'true'
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '10000'))
+KNN_K = int(os.getenv('KNN_K', '5'))
+KNN_NUM_CANDIDATES = int(os.getenv('KNN_NUM_CANDIDATES', '100'))
+# Everything build_prompt needs plus the ids, never the 384-float text_vector.
+SOURCE_FIELDS = ["id", "name", "description", "ingredients", "steps", "tags", "n_ingredients", "n_steps"]
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+HYBRID_RRF_K = int(os.getenv('HYBRID_RRF_K', '60'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '2000'))
+CONTEXT_MAX_STEPS = int(os.getenv('CONTEXT_MAX_STEPS', '10'))
+CONTEXT_MAX_DESCRIPTION_CHARS = int(os.getenv('CONTEXT_MAX_DESCRIPTION_CHARS', '300'))
+# 'local' serves vector queries from the in-process index written by prep.py.
+RETRIEVAL_BACKEND = os.getenv('RETRIEVAL_BACKEND', 'elasticsearch')
+VECTOR_INDEX_DIR = os.getenv('VECTOR_INDEX_DIR', 'vector_index')
+LOCAL_VECTOR_NPROBE = int(os.getenv('LOCAL_VECTOR_NPROBE', '16'))
+INGREDIENT_INDEX_PATH = os.getenv('INGREDIENT_INDEX_PATH', 'ingredient_index.npz')
+# Queries naming at least this many known ingredients are answered from the ingredient index.
+INGREDIENT_MIN_TERMS = int(os.getenv('INGREDIENT_MIN_TERMS', '2'))
+INGREDIENT_CANDIDATES = int(os.getenv('INGREDIENT_CANDIDATES', '50'))
+EVAL_WORKERS = int(os.getenv('EVAL_WORKERS', '2'))
+# Models after the chosen one in this chain are tried when it fails, so it
+# is ordered from the most to the least expensive.
+LLM_FALLBACK_CHAIN = [m for m in os.getenv('LLM_FALLBACK_CHAIN', 'openai/gpt-4o,openai/gpt-4o-mini,ollama/phi3').split(',') if m]
+# Fallbacks for models that are not in the chain, e.g.
+# "openai/gpt-3.5-turbo=ollama/phi3"; several are separated by "|".
+LLM_FALLBACKS = {
+    model: [m for m in fallbacks.split('|') if m]
+    for model, fallbacks in (item.split('=') for item in os.getenv('LLM_FALLBACKS', 'openai/gpt-3.5-turbo=ollama/phi3').split(',') if item)
+}
+# Requests per minute per model, e.g. "openai/gpt-4o=500,ollama/phi3=60".
+LLM_RATE_LIMITS = {
+    model: float(rpm)
+    for model, rpm in (item.split('=') for item in os.getenv('LLM_RATE_LIMITS', '').split(',') if item)
+}
+LLM_DEFAULT_RPM = float(os.getenv('LLM_DEFAULT_RPM', '500'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_INITIAL_BACKOFF = float(os.getenv('LLM_INITIAL_BACKOFF', '1'))
+LLM_MAX_RATE_LIMIT_WAIT = float(os.getenv('LLM_MAX_RATE_LIMIT_WAIT', '10'))
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '30'))
+PIPELINE_CONCURRENCY = int(os.getenv('PIPELINE_CONCURRENCY', '16'))
+SEARCH_TIMEOUT = float(os.getenv('SEARCH_TIMEOUT', '5'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+EVAL_TIMEOUT = float(os.getenv('EVAL_TIMEOUT', '60'))
+# 'eager' builds the clients and loads the model during import, 'background'
+# starts doing so in a thread right after it; anything else waits for first use.
+PRELOAD = os.getenv('PRELOAD', 'none')
 
 
-es_client = Elasticsearch(ELASTIC_URL) 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-ollama_client = OpenAI(base_url=OLLAMA_URL, api_key="ollama")
-model = SentenceTransformer(MODEL_NAME)
+def load_embedding_model():
+    # torch comes in with sentence_transformers, only import it when the model is needed.
+    from sentence_transformers import SentenceTransformer
 
+    start_time = time.time()
+    embedding_model = SentenceTransformer(MODEL_NAME)
+    if EMBED_QUANTIZE:
+        import torch
+        embedding_model = torch.quantization.quantize_dynamic(
+            embedding_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    # The first encode pays for lazy initialisation inside torch, do it now
+    # instead of on the first user request.
+    embedding_model.encode("warm up")
+    print(f"Loaded embedding model {MODEL_NAME} in {time.time() - start_time:.2f}s", flush=True)
+    return embedding_model
+
+
+# Clients, the embedding model and the local indexes are built on first use,
+# so importing this module stays cheap; see preload().
+model = Lazy('embedding_model', load_embedding_model)
+vector_index = Lazy('vector_index', lambda: VectorIndex(VECTOR_INDEX_DIR) if RETRIEVAL_BACKEND == 'local' else None)
+ingredient_index = Lazy(
+    'ingredient_index',
+    lambda: IngredientIndex(INGREDIENT_INDEX_PATH) if os.path.exists(INGREDIENT_INDEX_PATH) else None,
+)
+query_vector_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+semantic_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES)
+async_es_client = Lazy('async_es_client', lambda: AsyncElasticsearch(ELASTIC_URL))
+# Retries and timeouts are handled by llm_router, not by the SDK.
+async_openai_client = Lazy('async_openai_client', lambda: AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0))
+async_ollama_client = Lazy(
+    'async_ollama_client', lambda: AsyncOpenAI(base_url=OLLAMA_URL, api_key="ollama", max_retries=0)
+)
+llm_router = LLMRouter(
+    LLM_FALLBACK_CHAIN,
+    LLM_RATE_LIMITS,
+    LLM_DEFAULT_RPM,
+    max_retries=LLM_MAX_RETRIES,
+    initial_backoff=LLM_INITIAL_BACKOFF,
+    max_rate_limit_wait=LLM_MAX_RATE_LIMIT_WAIT,
+    failure_threshold=LLM_BREAKER_THRESHOLD,
+    reset_timeout=LLM_BREAKER_RESET,
+    fallbacks=LLM_FALLBACKS,
+)
+
+
+def start_event_loop():
+    # The async pipeline and its clients live on one loop in a daemon thread,
+    # shared by every Streamlit session; sync callers submit coroutines to it.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='answer-pipeline', daemon=True).start()
+    return loop
+
+
+pipeline_loop = Lazy('pipeline_loop', start_event_loop)
+pipeline_semaphores = {}
+background_tasks = set()
+
+
+def run_async(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, pipeline_loop.get()).result()
+
+
+def pipeline_semaphore(name, limit):
+    # Created on first use from inside the pipeline loop, so it is bound to it.
+    semaphore = pipeline_semaphores.get(name)
+    if semaphore is None:
+        semaphore = pipeline_semaphores[name] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def encode_query(query):
+    key = normalize_query(query)
+    with span('encode') as attributes:
+        vector = query_vector_cache.get(key)
+        attributes['cached'] = vector is not None
+        if vector is None:
+            vector = model.get().encode(key)
+            query_vector_cache.set(key, vector)
+    return vector
+
+
+def get_query_cache_stats():
+    return query_vector_cache.stats()
 
-def elastic_search_text(query, index_name="recipes"):
-    search_query = {
-        "size": 5,
+
+def text_search_query(query, size=5, filters=None):
+    return {
+        "size": size,
         "query": {
             "bool": {
                 "must": {
@@ -31,38 +178,79 @@ def elastic_search_text(query, index_name="recipes"):
                         "fields": ["ingredients", "steps", "name", "description", "tags"],
                         "type": "best_fields",
                     }
-                }
+                },
+                "filter": filters or [],
             }
         },
+        "_source": SOURCE_FIELDS,
     }
 
-    res = es_client.search(index=index_name, body=search_query)
-    result_docs = []
-    for hit in res["hits"]["hits"]:
-        result_docs.append(hit['_source'])
-    
-    return result_docs
 
-
-def elastic_search_knn(vector, field="text_vector", index_name="recipes"):
+def knn_search_query(vector, field="text_vector", size=KNN_K, num_candidates=KNN_NUM_CANDIDATES, filters=None):
+    # Filters are applied inside the HNSW search, so k hits are returned even
+    # when the constraints rule out most of the nearest neighbours.
     knn = {
         "field": field,
         "query_vector": vector,
-        "k": 5,
-        "num_candidates": 10000,
+        "k": size,
+        "num_candidates": max(num_candidates, size),
     }
+    if filters:
+        knn["filter"] = filters
 
-    search_query = {
+    return {
         "knn": knn,
-        "_source": ["ingredients", "steps", "name", "description", "tags"]
+        "size": size,
+        "_source": SOURCE_FIELDS
     }
 
-    res = es_client.search(index=index_name, body=search_query)
-    result_docs = []
-    for hit in res["hits"]["hits"]:
-        result_docs.append(hit['_source'])
-    
-    return result_docs
+
+def parse_ingredients(query):
+    if ingredient_index.get() is None:
+        return []
+    return ingredient_index.get().parse_query(query)
+
+
+def ingredient_candidates(query):
+    # Ranked (id, score) pairs from the ingredient posting lists, or [] when
+    # the query names too few known ingredients.
+    ingredients = parse_ingredients(query)
+    if len(ingredients) < INGREDIENT_MIN_TERMS:
+        return []
+    return ingredient_index.get().search(ingredients, size=INGREDIENT_CANDIDATES)
+
+
+def local_knn_hits(vector, size, constraints):
+    # None when vector queries are not served from the local index.
+    if vector_index.get() is None:
+        return None
+    return vector_index.get().search(vector, k=size, constraints=constraints, nprobe=LOCAL_VECTOR_NPROBE)
+
+
+def ingredient_search_query(candidates, filters=None):
+    return {
+        "size": len(candidates),
+        "query": {"bool": {"filter": [{"ids": {"values": [doc_id for doc_id, _ in candidates]}}] + (filters or [])}},
+        "_source": SOURCE_FIELDS,
+    }
+
+
+def order_by_candidates(hits, candidates, size=5):
+    rank = {doc_id: i for i, (doc_id, _) in enumerate(candidates)}
+    hits = sorted(hits, key=lambda hit: rank[hit['_id']])
+    return [hit['_source'] for hit in hits[:size]]
+
+
+def reciprocal_rank_fusion(hit_lists, size=5, k=HYBRID_RRF_K):
+    scores = {}
+    sources = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + 1.0 / (k + rank)
+            sources.setdefault(hit['_id'], hit['_source'])
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [sources[doc_id] for doc_id in ranked]
 
 
 def build_prompt(query, search_results):
@@ -77,49 +265,136 @@ CONTEXT:
 {context}
 """.strip()
 
+    context, tokens_saved = build_context(search_results)
+    prompt = prompt_template.format(question=query, context=context).strip()
+    return prompt, tokens_saved
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def format_recipe(doc, compact=False):
+    description = doc['description']
+    steps = doc['steps']
+    if compact:
+        if description and len(description) > CONTEXT_MAX_DESCRIPTION_CHARS:
+            description = description[:CONTEXT_MAX_DESCRIPTION_CHARS].rsplit(' ', 1)[0] + '...'
+        step_list = parse_list(steps)
+        if len(step_list) > CONTEXT_MAX_STEPS:
+            steps = step_list[:CONTEXT_MAX_STEPS] + [f"... {len(step_list) - CONTEXT_MAX_STEPS} more steps"]
+    return f"Recipe title: {doc['name']}\ndescription: {description}\ningredients: {doc['ingredients']}\nsteps: {steps}\n\n"
+
+
+def build_context(search_results, budget=CONTEXT_TOKEN_BUDGET):
+    # Adds recipes in rank order while they fit the token budget, shortening
+    # long descriptions and step lists before dropping a recipe altogether.
+    # Returns the context and the tokens saved against pasting every recipe in full.
     context = ""
-    
+    used = 0
+    full_tokens = 0
     for doc in search_results:
-        context += f"Recipe title: {doc['name']}\ndescription: {doc['description']}\ningredients: {doc['ingredients']}\nsteps: {doc['steps']}\n\n"
-    
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+        entry = format_recipe(doc)
+        tokens = estimate_tokens(entry)
+        full_tokens += tokens
+        if used + tokens > budget:
+            entry = format_recipe(doc, compact=True)
+            tokens = estimate_tokens(entry)
+            if used + tokens > budget:
+                continue
+        context += entry
+        used += tokens
 
+    return context, full_tokens - used
 
-def llm(prompt, model_choice):
-    start_time = time.time()
+
+def route_attributes(route):
+    return {'model': route['model'], 'attempts': route['attempts'], 'errors': route['errors']}
+
+
+def get_llm_client(model_choice):
     if model_choice.startswith('ollama/'):
-        response = ollama_client.chat.completions.create(
-            model=model_choice.split('/')[-1],
-            messages=[{"role": "user", "content": prompt}]
-        )
-        answer = response.choices[0].message.content
-        tokens = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
-        }
+        return async_ollama_client.get()
     elif model_choice.startswith('openai/'):
-        response = openai_client.chat.completions.create(
-            model=model_choice.split('/')[-1],
-            messages=[{"role": "user", "content": prompt}]
+        return async_openai_client.get()
+    raise ValueError(f"Unknown model choice: {model_choice}")
+
+
+def chat_completion(model, prompt, **options):
+    return get_llm_client(model).chat.completions.create(
+        model=model.split('/')[-1],
+        messages=[{"role": "user", "content": prompt}],
+        **options
+    )
+
+
+async def llm_async(prompt, model_choice, timeout=LLM_TIMEOUT, stage='llm'):
+    # Returns the answer, tokens, response time and the route taken through
+    # the fallback chain (see llm_router). stage names the trace span.
+    async def request(model):
+        return await asyncio.wait_for(chat_completion(model, prompt), timeout)
+
+    start_time = time.time()
+    with span(stage, requested_model=model_choice) as attributes:
+        response, route = await llm_router.call_async(model_choice, request)
+        attributes.update(route_attributes(route))
+    tokens = {
+        'prompt_tokens': response.usage.prompt_tokens,
+        'completion_tokens': response.usage.completion_tokens,
+        'total_tokens': response.usage.total_tokens
+    }
+    return response.choices[0].message.content, tokens, time.time() - start_time, route
+
+
+async def llm_stream_async(prompt, model_choice, usage):
+    # Yields answer chunks as they arrive. Once exhausted, usage holds the full
+    # answer, token counts, response_time and time_to_first_token.
+    # Only opening the stream goes through the router; once chunks have been
+    # shown to the user a failure can no longer fall back to another model.
+    async def request(model):
+        return await chat_completion(
+            model, prompt, stream=True, stream_options={"include_usage": True}, timeout=LLM_TIMEOUT
         )
-        answer = response.choices[0].message.content
+
+    start_time = time.time()
+    stream, route = await llm_router.call_async(model_choice, request)
+
+    chunks = []
+    tokens = None
+    first_token_time = None
+    async for chunk in stream:
+        if chunk.usage is not None:
+            tokens = {
+                'prompt_tokens': chunk.usage.prompt_tokens,
+                'completion_tokens': chunk.usage.completion_tokens,
+                'total_tokens': chunk.usage.total_tokens
+            }
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token_time is None:
+                first_token_time = time.time()
+            chunks.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+
+    end_time = time.time()
+    if tokens is None:
+        # Servers that ignore include_usage: roughly one token per chunk,
+        # four characters per prompt token.
+        prompt_tokens = len(prompt) // 4
         tokens = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(chunks),
+            'total_tokens': prompt_tokens + len(chunks)
         }
-    else:
-        raise ValueError(f"Unknown model choice: {model_choice}")
-        
-    end_time = time.time()
-    response_time = end_time - start_time
-    
-    return answer, tokens, response_time
+    usage.update({
+        'answer': "".join(chunks),
+        'tokens': tokens,
+        'response_time': end_time - start_time,
+        'time_to_first_token': (first_token_time or end_time) - start_time,
+        'route': route,
+    })
 
 
-def evaluate_relevance(question, answer):
+def relevance_prompt(question, answer):
     prompt_template = """
     You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
     Your task is to analyze the relevance of the generated answer to the given question.
@@ -140,9 +415,17 @@ def evaluate_relevance(question, answer):
     }}
     """.strip()
 
-    prompt = prompt_template.format(question=question, answer=answer)
-    evaluation, tokens, _ = llm(prompt, 'openai/gpt-4o-mini')
-    
+    return prompt_template.format(question=question, answer=answer)
+
+
+async def evaluate_relevance_async(question, answer):
+    evaluation, tokens, _, _ = await llm_async(
+        relevance_prompt(question, answer), 'openai/gpt-4o-mini', EVAL_TIMEOUT, 'evaluate_relevance'
+    )
+    return parse_relevance(evaluation, tokens)
+
+
+def parse_relevance(evaluation, tokens):
     try:
         json_eval = json.loads(evaluation)
         return json_eval['Relevance'], json_eval['Explanation'], tokens
@@ -159,29 +442,344 @@ def calculate_openai_cost(model_choice, tokens):
 
     return openai_cost
 
-def get_answer(query, model_choice, search_type):
+def get_cached_answer(query_vector, model_choice, search_type):
+    start_time = time.time()
+    with span('semantic_cache') as attributes:
+        entry, similarity = semantic_cache.lookup(query_vector, model_choice, search_type)
+        attributes['hit'] = entry is not None
+    if entry is None:
+        return None
+
+    answer_data = {key: value for key, value in entry.items() if key != 'id'}
+    answer_data['response_time'] = time.time() - start_time
+    answer_data['openai_cost'] = 0
+    answer_data['cache_hit'] = True
+    answer_data['cache_saved_cost'] = entry['openai_cost']
+    # No tokens were spent on this answer, the stats rollups must not count
+    # the original ones again; what was avoided is kept next to the cost.
+    answer_data['cache_saved_tokens'] = entry['total_tokens'] + entry['eval_total_tokens']
+    for field in ('prompt_tokens', 'completion_tokens', 'total_tokens',
+                  'eval_prompt_tokens', 'eval_completion_tokens', 'eval_total_tokens'):
+        answer_data[field] = 0
+    answer_data['cache_similarity'] = similarity
+    answer_data['time_to_first_token'] = answer_data['response_time']
+    answer_data['retrieval_time'] = 0.0
+    answer_data['search_latency'] = {}
+    answer_data['context_tokens_saved'] = 0
+    answer_data['requested_model'] = model_choice
+    answer_data['llm_latency'] = 0.0
+    answer_data['llm_attempts'] = 0
+    answer_data['llm_errors'] = 0
+    answer_data['llm_error'] = None
+    return answer_data
+
+
+async def search_async(search_query, index_name="recipes"):
+    return await asyncio.wait_for(async_es_client.get().search(index=index_name, body=search_query), SEARCH_TIMEOUT)
+
+
+async def knn_hits_async(vector_task, size, filters, constraints):
+    vector = await vector_task
+    # Index loading and the search itself are CPU work, kept off the shared pipeline loop.
+    hits = await asyncio.to_thread(local_knn_hits, vector, size, constraints)
+    if hits is not None:
+        return hits, None
+    res = await search_async(knn_search_query(vector, size=size, filters=filters))
+    return res['hits']['hits'], res['took']
+
+
+async def hybrid_search_async(query, vector_task, filters, constraints):
+    # Both legs run at the same time, the BM25 one while the query is still
+    # being encoded, and are merged with reciprocal rank fusion. A failed leg
+    # is logged and left out; with both failed there are no results.
+    async def timed_leg(name, leg):
+        with span(name):
+            start_time = time.time()
+            result = await leg
+            return result, (time.time() - start_time) * 1000
+
+    start_time = time.time()
+    text_leg, knn_leg = await asyncio.gather(
+        timed_leg('text_search', search_async(text_search_query(query, size=HYBRID_CANDIDATES, filters=filters))),
+        timed_leg('knn_search', knn_hits_async(vector_task, HYBRID_CANDIDATES, filters, constraints)),
+        return_exceptions=True,
+    )
+    latency = {'total_ms': (time.time() - start_time) * 1000}
+
+    hit_lists = []
+    if isinstance(text_leg, Exception):
+        print(f"Hybrid search text leg failed: {text_leg!r}", flush=True)
+    else:
+        hit_lists.append(text_leg[0]['hits']['hits'])
+        latency['text_ms'] = text_leg[1]
+    if isinstance(knn_leg, Exception):
+        print(f"Hybrid search knn leg failed: {knn_leg!r}", flush=True)
+    else:
+        hit_lists.append(knn_leg[0][0])
+        latency['knn_ms'] = knn_leg[1]
+
+    return reciprocal_rank_fusion(hit_lists), latency
+
+
+async def search_recipes_async(query, vector_task, search_type):
+    # The retrieval step of the answer pipeline. vector_task resolves to the
+    # query embedding and is only awaited by Vector and Hybrid searches.
+    # Returns the recipes and per-leg latencies.
+    start_time = time.time()
+    constraints = parse_constraints(query)
+    filters = build_es_filters(constraints)
+    search_latency = {}
     if search_type == 'Vector':
-        vector = model.encode(query)
-        search_results = elastic_search_knn(field='text_vector', vector=vector)
+        hits, _ = await knn_hits_async(vector_task, KNN_K, filters, constraints)
+        search_results = [hit['_source'] for hit in hits]
+    elif search_type == 'Hybrid':
+        search_results, search_latency = await hybrid_search_async(query, vector_task, filters, constraints)
     else:
-        search_results = elastic_search_text(query)
+        search_results = []
+        candidates = await asyncio.to_thread(ingredient_candidates, query)
+        if candidates:
+            res = await search_async(ingredient_search_query(candidates, filters))
+            search_results = order_by_candidates(res['hits']['hits'], candidates)
+            search_latency = {'ingredient_ms': (time.time() - start_time) * 1000}
+        if not search_results:
+            res = await search_async(text_search_query(query, filters=filters))
+            search_results = [hit['_source'] for hit in res['hits']['hits']]
+    return search_results, search_latency
+
+
+def search_recipes(query, query_vector, search_type):
+    # search_recipes_async for sync callers such as benchmark.py.
+    async def search():
+        vector_task = asyncio.get_running_loop().create_future()
+        vector_task.set_result(query_vector)
+        return await search_recipes_async(query, vector_task, search_type)
+
+    return run_async(search())
+
+
+async def retrieve_async(query, vector_task, search_type):
+    start_time = time.time()
+    with span('retrieval', search_type=search_type) as attributes:
+        search_results, search_latency = await search_recipes_async(query, vector_task, search_type)
+        attributes.update(search_latency, results=len(search_results))
+
+    retrieval = {'retrieval_time': time.time() - start_time, 'search_latency': search_latency}
+    with span('build_prompt') as attributes:
+        prompt, retrieval['context_tokens_saved'] = build_prompt(query, search_results)
+        attributes['context_tokens_saved'] = retrieval['context_tokens_saved']
+    return prompt, retrieval
+
 
-    prompt = build_prompt(query, search_results)
-    answer, tokens, response_time = llm(prompt, model_choice)
-    relevance, explanation, eval_tokens = evaluate_relevance(query, answer)
-    openai_cost = calculate_openai_cost(model_choice, tokens)
+async def prepare_answer_async(query, model_choice, search_type):
+    # Returns either a cached answer, or the prompt to send to the LLM together
+    # with retrieval timings. Retrieval starts alongside the query encoding and
+    # cache lookup and is dropped on a cache hit.
+    vector_task = None
+    if SEMANTIC_CACHE_ENABLED or search_type in ('Vector', 'Hybrid'):
+        vector_task = asyncio.ensure_future(asyncio.to_thread(encode_query, query))
+    retrieval_task = asyncio.ensure_future(retrieve_async(query, vector_task, search_type))
 
+    try:
+        if SEMANTIC_CACHE_ENABLED:
+            query_vector = await vector_task
+            cached = await asyncio.to_thread(get_cached_answer, query_vector, model_choice, search_type)
+            if cached is not None:
+                return cached, None, None
+        prompt, retrieval = await retrieval_task
+        return None, prompt, retrieval
+    finally:
+        if not retrieval_task.done():
+            retrieval_task.cancel()
+            # Lets the cancelled retrieval record its span before the trace is exported.
+            await asyncio.gather(retrieval_task, return_exceptions=True)
+
+
+def get_answer(query, model_choice, search_type, conversation_id=None):
+    return run_async(get_answer_async(query, model_choice, search_type, conversation_id))
+
+
+async def get_answer_async(query, model_choice, search_type, conversation_id=None):
+    # With a conversation_id the answer is also saved and evaluated in the background.
+    with trace(conversation_id, 'answer', search_type=search_type, requested_model=model_choice):
+        semaphore = pipeline_semaphore('answers', PIPELINE_CONCURRENCY)
+        with span('queue'):
+            await semaphore.acquire()
+        try:
+            answer_data, prompt, retrieval = await prepare_answer_async(query, model_choice, search_type)
+            if answer_data is None:
+                answer, tokens, response_time, route = await llm_async(prompt, model_choice)
+                answer_data = build_answer_data(
+                    answer, tokens, response_time, response_time, model_choice, retrieval, route
+                )
+        finally:
+            semaphore.release()
+
+    persist_in_background(conversation_id, query, search_type, answer_data)
+    return answer_data
+
+
+def get_answer_stream_async(query, model_choice, search_type, conversation_id=None):
+    # Returns an async generator of answer chunks and a dict that is filled
+    # with the same fields as get_answer once the generator is exhausted.
+    # Chunks may be pulled from different tasks (see iterate_sync), so spans
+    # that stay open across a yield use timed instead of the context.
+    answer_data = {}
+
+    async def stream():
+        active = start_trace(conversation_id, 'answer', search_type=search_type, requested_model=model_choice)
+        with finishing(active):
+            semaphore = pipeline_semaphore('answers', PIPELINE_CONCURRENCY)
+            with timed(active, 'queue'):
+                await semaphore.acquire()
+            try:
+                with activate(active):
+                    cached, prompt, retrieval = await prepare_answer_async(query, model_choice, search_type)
+                if cached is not None:
+                    answer_data.update(cached)
+                    yield cached['answer']
+                else:
+                    usage = {}
+                    with timed(active, 'llm', requested_model=model_choice, stream=True) as attributes:
+                        async for chunk in llm_stream_async(prompt, model_choice, usage):
+                            yield chunk
+                        attributes.update(route_attributes(usage['route']), time_to_first_token=usage['time_to_first_token'])
+                    answer_data.update(build_answer_data(
+                        usage['answer'], usage['tokens'], usage['response_time'], usage['time_to_first_token'],
+                        model_choice, retrieval, usage['route']
+                    ))
+            finally:
+                semaphore.release()
+
+        persist_in_background(conversation_id, query, search_type, answer_data)
+
+    return stream(), answer_data
+
+
+def iterate_sync(stream):
+    # Runs an async generator on the pipeline loop one item at a time, for
+    # sync consumers such as st.write_stream.
+    try:
+        while True:
+            try:
+                yield run_async(stream.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(stream.aclose())
+
+
+def build_answer_data(answer, tokens, response_time, time_to_first_token, model_choice, retrieval, route):
+    # model_used is the model that actually answered, which differs from
+    # model_choice when the router fell back.
+    openai_cost = calculate_openai_cost(route['model'], tokens)
+
+    # Relevance is filled in later by persist_and_evaluate_async.
     return {
         'answer': answer,
         'response_time': response_time,
-        'relevance': relevance,
-        'relevance_explanation': explanation,
-        'model_used': model_choice,
+        'time_to_first_token': time_to_first_token,
+        'retrieval_time': retrieval['retrieval_time'],
+        'search_latency': retrieval['search_latency'],
+        'context_tokens_saved': retrieval['context_tokens_saved'],
+        'relevance': 'PENDING',
+        'relevance_explanation': 'Evaluation pending',
+        'model_used': route['model'],
+        'requested_model': model_choice,
+        'llm_latency': route['latency'],
+        'llm_attempts': route['attempts'],
+        'llm_errors': route['errors'],
+        'llm_error': route['error'],
         'prompt_tokens': tokens['prompt_tokens'],
         'completion_tokens': tokens['completion_tokens'],
         'total_tokens': tokens['total_tokens'],
-        'eval_prompt_tokens': eval_tokens['prompt_tokens'],
-        'eval_completion_tokens': eval_tokens['completion_tokens'],
-        'eval_total_tokens': eval_tokens['total_tokens'],
-        'openai_cost': openai_cost
+        'eval_prompt_tokens': 0,
+        'eval_completion_tokens': 0,
+        'eval_total_tokens': 0,
+        'openai_cost': openai_cost,
+        'cache_hit': False,
+        'cache_saved_cost': 0,
+        'cache_saved_tokens': 0,
     }
+
+
+def persist_in_background(conversation_id, question, search_type, answer_data):
+    # Must be called from the pipeline loop. Without a conversation_id there is
+    # no row to record the evaluation on, so none is run.
+    if conversation_id is None:
+        if answer_data['relevance'] == 'PENDING':
+            answer_data.update(relevance='UNKNOWN', relevance_explanation='Not evaluated without a conversation')
+        return
+    task = asyncio.ensure_future(persist_and_evaluate_async(conversation_id, question, search_type, answer_data))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def persist_and_evaluate_async(conversation_id, question, search_type, answer_data):
+    with trace(conversation_id, 'persist_and_evaluate'):
+        # The evaluation call runs while the conversation row is written, the
+        # relevance update waits for both.
+        save_task = asyncio.ensure_future(
+            asyncio.to_thread(traced_save_conversation, conversation_id, question, answer_data)
+        )
+        if answer_data['relevance'] != 'PENDING':
+            await save_task
+            return
+
+        # Retries and fallbacks happen inside llm_router, a failure here is final.
+        result = None
+        async with pipeline_semaphore('evaluations', EVAL_WORKERS):
+            try:
+                result = await evaluate_relevance_async(question, answer_data['answer'])
+            except Exception as e:
+                print(f"Relevance evaluation for {conversation_id} failed: {e!r}", flush=True)
+                error = e
+
+        await save_task
+        if result is None:
+            empty_tokens = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+            with span('update_relevance'):
+                await asyncio.to_thread(
+                    update_relevance, conversation_id, 'UNKNOWN', f"Evaluation failed: {error!r}", empty_tokens
+                )
+        else:
+            await asyncio.to_thread(record_relevance, conversation_id, question, search_type, answer_data, *result)
+
+
+def record_relevance(conversation_id, question, search_type, answer_data, relevance, explanation, eval_tokens):
+    with span('update_relevance', relevance=relevance) as attributes:
+        attributes['updated'] = update_relevance(conversation_id, relevance, explanation, eval_tokens)
+
+    # Only answers the judge found relevant are served again; partly relevant
+    # or unevaluated (UNKNOWN) ones are not, nor ones whose conversation row
+    # was never written.
+    if SEMANTIC_CACHE_ENABLED and relevance == 'RELEVANT' and attributes['updated']:
+        evaluated = dict(
+            answer_data,
+            relevance=relevance,
+            relevance_explanation=explanation,
+            eval_prompt_tokens=eval_tokens['prompt_tokens'],
+            eval_completion_tokens=eval_tokens['completion_tokens'],
+            eval_total_tokens=eval_tokens['total_tokens'],
+        )
+        semantic_cache.add(question, encode_query(question), search_type, evaluated)
+
+
+def traced_save_conversation(conversation_id, question, answer_data):
+    with span('save_conversation'):
+        save_conversation(conversation_id, question, answer_data)
+
+
+def preload():
+    # Warm-up hook: builds everything that is otherwise created on first use,
+    # e.g. before a container reports itself ready.
+    for resource in (pipeline_loop, async_es_client, async_openai_client, async_ollama_client,
+                     ingredient_index, vector_index, model):
+        resource.get()
+    print(f"Assistant preloaded: {startup_report()}", flush=True)
+
+
+mark_imported('assistant')
+if PRELOAD == 'eager':
+    preload()
+elif PRELOAD == 'background':
+    threading.Thread(target=preload, name='preload', daemon=True).start()
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch
+from dotenv import load_dotenv
+from assistant import encode_query, knn_search_query, search_recipes
+from generate_data import SAMPLE_QUESTIONS
+from prep import fetch_ground_truth, GROUND_TRUTH_PATH
+
+load_dotenv()
+
+INDEX_NAME = os.getenv("INDEX_NAME", "recipes")
+SEARCH_MODES = ["Text", "Vector", "Hybrid"]
+
+
+def exact_search(es_client, vector, k, field="text_vector"):
+    # Brute-force cosine similarity over every document, the ground truth the
+    # approximate HNSW results are compared against.
+    search_query = {
+        "size": k,
+        "_source": False,
+        "query": {
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": f"cosineSimilarity(params.query_vector, '{field}') + 1.0",
+                    "params": {"query_vector": vector},
+                },
+            }
+        },
+    }
+    res = es_client.search(index=INDEX_NAME, body=search_query)
+    return [hit["_id"] for hit in res["hits"]["hits"]]
+
+
+def approximate_search(es_client, vector, k, num_candidates):
+    search_query = knn_search_query(vector, size=k, num_candidates=num_candidates)
+    search_query["_source"] = False
+    start_time = time.time()
+    res = es_client.search(index=INDEX_NAME, body=search_query)
+    latency = (time.time() - start_time) * 1000
+    return [hit["_id"] for hit in res["hits"]["hits"]], latency, res["took"]
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_knn_benchmark(es_client, questions, k, candidate_settings, repeats):
+    vectors = [encode_query(question).tolist() for question in questions]
+    truth = [set(exact_search(es_client, vector, k)) for vector in vectors]
+
+    results = []
+    for num_candidates in candidate_settings:
+        recalls, latencies, took = [], [], []
+        for _ in range(repeats):
+            for vector, expected in zip(vectors, truth):
+                ids, latency, es_took = approximate_search(es_client, vector, k, num_candidates)
+                recalls.append(len(expected.intersection(ids)) / max(len(expected), 1))
+                latencies.append(latency)
+                took.append(es_took)
+        results.append({
+            "num_candidates": num_candidates,
+            "k": k,
+            "recall": float(np.mean(recalls)),
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p95_ms": percentile(latencies, 95),
+            "es_took_p50_ms": percentile(took, 50),
+        })
+        print(
+            f"num_candidates={num_candidates:>6}  recall@{k}={results[-1]['recall']:.3f}  "
+            f"p50={results[-1]['latency_p50_ms']:.1f}ms  p95={results[-1]['latency_p95_ms']:.1f}ms"
+        )
+    return results
+
+
+def timed_search(record, search_type):
+    start_time = time.time()
+    results, _ = search_recipes(record["question"], encode_query(record["question"]), search_type)
+    latency = (time.time() - start_time) * 1000
+    ids = [str(doc.get("id")) for doc in results]
+    rank = ids.index(record["id"]) + 1 if record["id"] in ids else None
+    return rank, latency
+
+
+def summarize(ranks, latencies, elapsed=None):
+    summary = {
+        "queries": len(ranks),
+        "hit_rate": sum(rank is not None for rank in ranks) / max(len(ranks), 1),
+        "mrr": sum(1.0 / rank for rank in ranks if rank) / max(len(ranks), 1),
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+    }
+    if elapsed is not None:
+        summary["throughput_qps"] = len(ranks) / max(elapsed, 1e-9)
+    return summary
+
+
+def run_retrieval_benchmark(ground_truth, modes, workers):
+    # Questions are encoded up front, so the latencies cover the search alone.
+    for record in ground_truth:
+        encode_query(record["question"])
+
+    results = {}
+    for mode in modes:
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(lambda record: timed_search(record, mode), ground_truth))
+        elapsed = time.time() - start_time
+
+        ranks = [rank for rank, _ in outcomes]
+        latencies = [latency for _, latency in outcomes]
+        results[mode] = summarize(ranks, latencies, elapsed)
+        results[mode]["by_question_type"] = {}
+        for question_type in sorted({record["question_type"] for record in ground_truth}):
+            picked = [i for i, record in enumerate(ground_truth) if record["question_type"] == question_type]
+            results[mode]["by_question_type"][question_type] = summarize(
+                [ranks[i] for i in picked], [latencies[i] for i in picked]
+            )
+        summary = results[mode]
+        print(
+            f"{mode:>7}  hit_rate={summary['hit_rate']:.3f}  mrr={summary['mrr']:.3f}  "
+            f"p50={summary['latency_p50_ms']:.1f}ms  p95={summary['latency_p95_ms']:.1f}ms  "
+            f"p99={summary['latency_p99_ms']:.1f}ms  {summary['throughput_qps']:.0f} q/s"
+        )
+    return results
+
+
+def load_questions(path):
+    if path is None:
+        return SAMPLE_QUESTIONS
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    knn = subparsers.add_parser("knn", help="recall vs. latency of kNN search against exact search")
+    knn.add_argument("--es-url", default="http://localhost:9200")
+    knn.add_argument("--questions", help="file with one question per line, defaults to the sample questions")
+    knn.add_argument("--k", type=int, default=5)
+    knn.add_argument("--num-candidates", type=int, nargs="+", default=[10, 25, 50, 100, 250, 1000, 10000])
+    knn.add_argument("--repeats", type=int, default=3)
+    knn.add_argument("--output", default="knn_benchmark.json")
+
+    retrieval = subparsers.add_parser(
+        "retrieval", help="hit rate, MRR and latency of every search mode over (question, recipe id) pairs"
+    )
+    retrieval.add_argument("--ground-truth", default=GROUND_TRUTH_PATH, help="generated from the recipes if missing")
+    retrieval.add_argument("--modes", nargs="+", choices=SEARCH_MODES, default=SEARCH_MODES)
+    retrieval.add_argument("--workers", type=int, default=8)
+    retrieval.add_argument("--limit", type=int, help="only use the first N questions")
+    retrieval.add_argument("--output", default="retrieval_benchmark.json")
+
+    args = parser.parse_args()
+
+    if args.command == "knn":
+        es_client = Elasticsearch(args.es_url)
+        results = run_knn_benchmark(
+            es_client, load_questions(args.questions), args.k, args.num_candidates, args.repeats
+        )
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    elif args.command == "retrieval":
+        ground_truth = fetch_ground_truth(args.ground_truth)[:args.limit]
+        results = run_retrieval_benchmark(ground_truth, args.modes, args.workers)
+        with open(args.output, "w") as f:
+            json.dump({"ground_truth": args.ground_truth, "workers": args.workers, "modes": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
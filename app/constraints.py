@@ -0,0 +1,77 @@
+import re
+
+# Time limits map onto the food.com duration tags present on the recipes.
+TIME_TAGS = [
+    (15, "15-minutes-or-less"),
+    (30, "30-minutes-or-less"),
+    (60, "60-minutes-or-less"),
+    (240, "4-hours-or-less"),
+]
+
+DIET_TAGS = {
+    "vegetarian": "vegetarian",
+    "vegan": "vegan",
+    "gluten free": "gluten-free",
+    "gluten-free": "gluten-free",
+    "dairy free": "dairy-free",
+    "dairy-free": "dairy-free",
+    "low carb": "low-carb",
+    "low-carb": "low-carb",
+    "low fat": "low-fat",
+    "low-fat": "low-fat",
+}
+
+MINUTES_PATTERN = re.compile(r"(\d+)\s*(?:-\s*)?(minutes?|mins?|hours?|hrs?)\b")
+INGREDIENTS_PATTERN = re.compile(r"(\d+)\s+ingredients?\b")
+STEPS_PATTERN = re.compile(r"(\d+)\s+steps?\b")
+
+
+def parse_constraints(query):
+    # Pulls hard limits the user states in plain text ("I have 30 minutes",
+    # "5 ingredients or less", "vegetarian") out of the query.
+    text = query.lower()
+    constraints = {}
+
+    match = MINUTES_PATTERN.search(text)
+    if match:
+        minutes = int(match.group(1))
+        if match.group(2).startswith("h"):
+            minutes *= 60
+        # Recipes carry only their tightest duration tag, so "2 hours" has to
+        # accept every bucket up to 4-hours-or-less.
+        for i, (limit, _) in enumerate(TIME_TAGS):
+            if minutes <= limit:
+                constraints["time_tags"] = [tag for _, tag in TIME_TAGS[: i + 1]]
+                break
+
+    match = INGREDIENTS_PATTERN.search(text)
+    if match:
+        constraints["max_ingredients"] = int(match.group(1))
+
+    match = STEPS_PATTERN.search(text)
+    if match:
+        constraints["max_steps"] = int(match.group(1))
+
+    diet = sorted({tag for phrase, tag in DIET_TAGS.items() if re.search(rf"\b{phrase}\b", text)})
+    if diet:
+        constraints["diet_tags"] = diet
+
+    return constraints
+
+
+def build_es_filters(constraints):
+    filters = []
+    if "max_ingredients" in constraints:
+        filters.append({"range": {"n_ingredients": {"lte": constraints["max_ingredients"]}}})
+    if "max_steps" in constraints:
+        filters.append({"range": {"n_steps": {"lte": constraints["max_steps"]}}})
+    for tag in constraints.get("diet_tags", []):
+        filters.append({"match_phrase": {"tags": tag}})
+    if "time_tags" in constraints:
+        filters.append({
+            "bool": {
+                "should": [{"match_phrase": {"tags": tag}} for tag in constraints["time_tags"]],
+                "minimum_should_match": 1,
+            }
+        })
+    return filters
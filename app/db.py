@@ -1,82 +1,524 @@
+import atexit
+import json
 import os
+import threading
+import time
 import psycopg2
-from psycopg2.extras import DictCursor
+from contextlib import contextmanager
+from psycopg2.extensions import connection as BaseConnection
+from psycopg2.extras import DictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.errors import UndefinedColumn, UndefinedTable
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
+from migrations import run_migrations
+from cache import TTLCache
 
 tz = ZoneInfo("Europe/Berlin")
-load_dotenv
-
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("POSTGRES_HOST"),
-        database=os.getenv("POSTGRES_DB"),
-        user=os.getenv("POSTGRES_USER"),
-        password=os.getenv("POSTGRES_PASSWORD"),
-    )
+load_dotenv()
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "100"))
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "1.0"))
+DB_WRITE_PAGE_SIZE = 1000
+# Trace spans are dropped, oldest first, beyond this many waiting rows
+# while the database is unreachable; conversations and feedback never are.
+DB_WRITE_MAX_PENDING_SPANS = int(os.getenv("DB_WRITE_MAX_PENDING_SPANS", "10000"))
+# Buffered rows are kept for the next flush on these; on any other database
+# error the batch is written row by row and the rows that fail are dropped.
+RETRY_WRITE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError, UndefinedTable, UndefinedColumn)
+BAD_ROW_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError, psycopg2.ProgrammingError)
+# Streamlit reruns the whole script on every interaction; the dashboard reads
+# are served from this cache and refreshed after writes or when it expires.
+DB_READ_CACHE_TTL = float(os.getenv("DB_READ_CACHE_TTL", "5"))
 
-def init_db():
-    conn = get_db_connection()
+
+class PooledConnection(BaseConnection):
+    # Tracks what the pool needs to know about each connection.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+        self.prepared = set()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    "checkouts": 0,
+    "in_use": 0,
+    "timeouts": 0,
+    "reconnects": 0,
+    "wait_time": 0.0,
+    "max_wait_time": 0.0,
+}
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    host=os.getenv("POSTGRES_HOST"),
+                    database=os.getenv("POSTGRES_DB"),
+                    user=os.getenv("POSTGRES_USER"),
+                    password=os.getenv("POSTGRES_PASSWORD"),
+                    connection_factory=PooledConnection,
+                )
+    return _pool
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_HEALTHCHECK_INTERVAL:
+        return True
     try:
         with conn.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS feedback")
-            cur.execute("DROP TABLE IF EXISTS conversations")
-
-            cur.execute("""
-                CREATE TABLE conversations (
-                    id TEXT PRIMARY KEY,
-                    question TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    model_used TEXT NOT NULL,
-                    response_time FLOAT NOT NULL,
-                    relevance TEXT NOT NULL,
-                    relevance_explanation TEXT NOT NULL,
-                    prompt_tokens INTEGER NOT NULL,
-                    completion_tokens INTEGER NOT NULL,
-                    total_tokens INTEGER NOT NULL,
-                    eval_prompt_tokens INTEGER NOT NULL,
-                    eval_completion_tokens INTEGER NOT NULL,
-                    eval_total_tokens INTEGER NOT NULL,
-                    openai_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE feedback (
-                    id SERIAL PRIMARY KEY,
-                    conversation_id TEXT REFERENCES conversations(id),
-                    feedback INTEGER NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
-            """)
-        conn.commit()
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _update_stats(**changes):
+    with _pool_stats_lock:
+        for key, value in changes.items():
+            _pool_stats[key] += value
+
+
+@contextmanager
+def db_connection():
+    # ThreadedConnectionPool raises as soon as it is exhausted, the semaphore
+    # makes callers queue for a free connection instead.
+    start_time = time.monotonic()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        _update_stats(timeouts=1)
+        raise PoolError(f"No database connection available after {DB_POOL_TIMEOUT}s")
+    waited = time.monotonic() - start_time
+    with _pool_stats_lock:
+        _pool_stats["checkouts"] += 1
+        _pool_stats["in_use"] += 1
+        _pool_stats["wait_time"] += waited
+        _pool_stats["max_wait_time"] = max(_pool_stats["max_wait_time"], waited)
+
+    pool = None
+    conn = None
+    broken = False
+    try:
+        # Inside the try so a failed first connect still gives the slot back.
+        pool = get_pool()
+        conn = pool.getconn()
+        if not _is_healthy(conn):
+            pool.putconn(conn, close=True)
+            _update_stats(reconnects=1)
+            conn = pool.getconn()
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
     finally:
-        conn.close()
+        try:
+            if conn is not None:
+                if broken or conn.closed:
+                    pool.putconn(conn, close=True)
+                else:
+                    conn.rollback()
+                    conn.last_used = time.monotonic()
+                    pool.putconn(conn)
+        finally:
+            _update_stats(in_use=-1)
+            _pool_slots.release()
 
 
-def save_conversation(conversation_id, question, answer_data, timestamp=None):
+def execute_prepared(cur, name, sql, params):
+    # Server-side prepared statement, parsed and planned once per connection.
+    prepared = cur.connection.prepared
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    execute = f"EXECUTE {name}"
+    if params:
+        execute += " (" + ", ".join(["%s"] * len(params)) + ")"
+    try:
+        cur.execute(execute, params)
+    except psycopg2.errors.FeatureNotSupported:
+        # The table changed shape since the statement was prepared.
+        cur.connection.rollback()
+        cur.execute(f"DEALLOCATE {name}")
+        cur.execute(f"PREPARE {name} AS {sql}")
+        cur.execute(execute, params)
+
+
+def get_pool_stats():
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["max_size"] = DB_POOL_MAX
+    stats["utilization"] = stats["in_use"] / DB_POOL_MAX
+    stats["avg_wait_time"] = stats["wait_time"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    return stats
+
+
+def init_db():
+    # Applies pending schema migrations; existing data is never dropped.
+    with db_connection() as conn:
+        run_migrations(conn)
+
+
+CONVERSATION_COLUMNS = [
+    "id",
+    "question",
+    "answer",
+    "model_used",
+    "response_time",
+    "time_to_first_token",
+    "retrieval_time",
+    "requested_model",
+    "llm_latency",
+    "llm_attempts",
+    "llm_errors",
+    "llm_error",
+    "relevance",
+    "relevance_explanation",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "eval_prompt_tokens",
+    "eval_completion_tokens",
+    "eval_total_tokens",
+    "openai_cost",
+    "cache_hit",
+    "cache_saved_cost",
+    "timestamp",
+]
+FEEDBACK_COLUMNS = ["conversation_id", "feedback", "timestamp"]
+TRACE_SPAN_COLUMNS = [
+    "trace_id",
+    "span_id",
+    "parent_id",
+    "name",
+    "start_time",
+    "duration_ms",
+    "status",
+    "attributes",
+]
+
+
+def conversation_row(conversation_id, question, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
-    
-    conn = get_db_connection()
-    try:
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data.get("time_to_first_token"),
+        answer_data.get("retrieval_time"),
+        answer_data.get("requested_model", answer_data["model_used"]),
+        answer_data.get("llm_latency"),
+        answer_data.get("llm_attempts"),
+        answer_data.get("llm_errors"),
+        answer_data.get("llm_error"),
+        answer_data["relevance"],
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        answer_data["openai_cost"],
+        answer_data.get("cache_hit", False),
+        answer_data.get("cache_saved_cost", 0),
+        timestamp,
+    )
+
+
+def feedback_row(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+    return (conversation_id, feedback, timestamp)
+
+
+def trace_span_row(span):
+    return (
+        span["trace_id"],
+        span["span_id"],
+        span["parent_id"],
+        span["name"],
+        datetime.fromtimestamp(span["start_time"], tz),
+        span["duration_ms"],
+        span["status"],
+        Json(span["attributes"], dumps=lambda value: json.dumps(value, default=str)),
+    )
+
+
+def insert_rows(cur, table, columns, rows):
+    execute_values(
+        cur,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+        rows,
+        page_size=DB_WRITE_PAGE_SIZE,
+    )
+
+
+class BufferedWriter:
+    # Queues rows per table and writes them in batches, either when
+    # batch_size rows are waiting or every flush_interval seconds. Tables are
+    # written in the order given, so conversations always land before the
+    # feedback that references them. max_pending optionally caps the rows
+    # kept per table, dropping the oldest ones.
+
+    def __init__(self, tables, batch_size, flush_interval, max_pending=None):
+        self.tables = tables
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending or {}
+        self._buffers = {table: [] for table, _ in tables}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def pending(self):
+        with self._lock:
+            return sum(len(rows) for rows in self._buffers.values())
+
+    def add(self, table, rows):
+        with self._lock:
+            self._buffers[table].extend(rows)
+            dropped = self._trim(table)
+            size = sum(len(buffered) for buffered in self._buffers.values())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        if dropped:
+            print(f"Write buffer full, dropped {dropped} {table} rows", flush=True)
+        if size >= self.batch_size:
+            self._wakeup.set()
+
+    def _trim(self, table):
+        # Called with _lock held, returns the number of rows dropped.
+        limit = self.max_pending.get(table)
+        excess = len(self._buffers[table]) - limit if limit is not None else 0
+        if excess <= 0:
+            return 0
+        del self._buffers[table][:excess]
+        return excess
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batches = self._buffers
+                self._buffers = {table: [] for table, _ in self.tables}
+            # One transaction per table, so a failing trace span insert can
+            # never take conversations or feedback down with it.
+            for position, (table, columns) in enumerate(self.tables):
+                if not batches[table]:
+                    continue
+                try:
+                    self._write(table, columns, batches[table])
+                except RETRY_WRITE_ERRORS:
+                    # Database unreachable or not migrated yet (prep.py applies
+                    # the migrations). Keep the rows of this table and of the
+                    # later ones, which may reference them, for the next attempt.
+                    self._requeue({later: batches[later] for later, _ in self.tables[position:]})
+                    raise
+
+    def _requeue(self, batches):
+        dropped = {}
+        with self._lock:
+            for table, rows in batches.items():
+                self._buffers[table][:0] = rows
+                dropped[table] = self._trim(table)
+        for table, count in dropped.items():
+            if count:
+                print(f"Database write failed, dropped {count} buffered {table} rows", flush=True)
+
+    def _write(self, table, columns, rows):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    insert_rows(cur, table, columns, rows)
+                conn.commit()
+        except RETRY_WRITE_ERRORS:
+            raise
+        except BAD_ROW_ERRORS:
+            # One bad row fails the whole batch, write row by row and drop the offenders.
+            self._write_one_by_one(table, columns, rows)
+
+    def _write_one_by_one(self, table, columns, rows):
+        with db_connection() as conn:
+            for row in rows:
+                try:
+                    with conn.cursor() as cur:
+                        insert_rows(cur, table, columns, [row])
+                    conn.commit()
+                except RETRY_WRITE_ERRORS:
+                    raise
+                except BAD_ROW_ERRORS as e:
+                    conn.rollback()
+                    print(f"Dropping {table} row {row[0]}: {e}", flush=True)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Buffered database write failed: {e}", flush=True)
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+writer = BufferedWriter(
+    [
+        ("conversations", CONVERSATION_COLUMNS),
+        ("feedback", FEEDBACK_COLUMNS),
+        ("trace_spans", TRACE_SPAN_COLUMNS),
+    ],
+    DB_WRITE_BATCH_SIZE,
+    DB_WRITE_FLUSH_INTERVAL,
+    max_pending={"trace_spans": DB_WRITE_MAX_PENDING_SPANS},
+)
+atexit.register(writer.close)
+
+
+def flush_writes():
+    # Always goes through flush(), which waits for a batch the writer thread
+    # may be committing right now; pending() would already be 0 for it.
+    writer.flush()
+
+
+read_cache = TTLCache(maxsize=64, ttl=DB_READ_CACHE_TTL)
+_read_cache_version = 0
+_read_cache_lock = threading.Lock()
+
+
+def cached_read(key, load):
+    # A read that started before a write must not cache what it saw, so the
+    # result is only kept when no invalidation happened in between.
+    value = read_cache.get(key)
+    if value is None:
+        with _read_cache_lock:
+            version = _read_cache_version
+        value = load()
+        with _read_cache_lock:
+            if version == _read_cache_version:
+                read_cache.set(key, value)
+    return value
+
+
+def invalidate_reads(feedback=0):
+    # feedback (+1 or -1) is added to the cached counters instead of dropping them.
+    global _read_cache_version
+    with _read_cache_lock:
+        _read_cache_version += 1
+        stats = read_cache.get("feedback_stats") if feedback else None
+        read_cache.clear()
+        if stats is not None:
+            read_cache.set("feedback_stats", {
+                "thumbs_up": stats["thumbs_up"] + (feedback > 0),
+                "thumbs_down": stats["thumbs_down"] + (feedback < 0),
+            })
+
+
+def save_conversation(conversation_id, question, answer_data, timestamp=None):
+    writer.add("conversations", [conversation_row(conversation_id, question, answer_data, timestamp)])
+    invalidate_reads()
+
+
+def save_feedback(conversation_id, feedback, timestamp=None):
+    writer.add("feedback", [feedback_row(conversation_id, feedback, timestamp)])
+    invalidate_reads(feedback)
+
+
+def save_trace_spans(spans):
+    writer.add("trace_spans", [trace_span_row(span) for span in spans])
+
+
+def bulk_insert(conversations=(), feedback=()):
+    # Synchronous bulk load for large batches of rows built with
+    # conversation_row and feedback_row, committed as one transaction.
+    flush_writes()
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if conversations:
+                insert_rows(cur, "conversations", CONVERSATION_COLUMNS, conversations)
+            if feedback:
+                insert_rows(cur, "feedback", FEEDBACK_COLUMNS, feedback)
+        conn.commit()
+    invalidate_reads()
+
+
+def update_relevance(conversation_id, relevance, explanation, eval_tokens):
+    # The conversation row may still be waiting in the write buffer.
+    flush_writes()
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP))
+                UPDATE conversations
+                SET relevance = %s, relevance_explanation = %s, eval_prompt_tokens = %s,
+                eval_completion_tokens = %s, eval_total_tokens = %s
+                WHERE id = %s
             """,
                 (
+                    relevance,
+                    explanation,
+                    eval_tokens["prompt_tokens"],
+                    eval_tokens["completion_tokens"],
+                    eval_tokens["total_tokens"],
                     conversation_id,
+                ),
+            )
+            updated = cur.rowcount > 0
+        conn.commit()
+    invalidate_reads()
+    if not updated:
+        print(f"No conversation {conversation_id} to record relevance on", flush=True)
+    return updated
+
+
+def save_answer_cache_entry(question, embedding, search_type, answer_data, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO answer_cache
+                (question, embedding, model_used, search_type, answer, relevance, relevance_explanation,
+                prompt_tokens, completion_tokens, total_tokens, eval_prompt_tokens, eval_completion_tokens,
+                eval_total_tokens, openai_cost, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """,
+                (
                     question,
-                    answer_data["answer"],
+                    [float(x) for x in embedding],
                     answer_data["model_used"],
-                    answer_data["response_time"],
+                    search_type,
+                    answer_data["answer"],
                     answer_data["relevance"],
                     answer_data["relevance_explanation"],
                     answer_data["prompt_tokens"],
@@ -89,56 +531,76 @@ def save_conversation(conversation_id, question, answer_data, timestamp=None):
                     timestamp,
                 ),
             )
+            entry_id = cur.fetchone()[0]
         conn.commit()
-    finally:
-        conn.close()
+        return entry_id
 
 
-def save_feedback(conversation_id, feedback, timestamp=None):
+def get_answer_cache_entries(limit):
+    # The most recently used answers that were judged relevant.
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT * FROM answer_cache
+                WHERE relevance = 'RELEVANT'
+                ORDER BY COALESCE(last_hit_at, created_at) DESC
+                LIMIT %s
+            """,
+                (limit,),
+            )
+            return cur.fetchall()
+
+
+def record_answer_cache_hit(entry_id, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))",
-                (conversation_id, feedback, timestamp),
+                "UPDATE answer_cache SET hits = hits + 1, last_hit_at = %s WHERE id = %s",
+                (timestamp, entry_id),
             )
         conn.commit()
-    finally:
-        conn.close()
 
 
 def get_recent_conversations(limit=5, relevance=None):
-    conn = get_db_connection()
-    try:
+    return cached_read(("recent_conversations", limit, relevance), lambda: load_recent_conversations(limit, relevance))
+
+
+def load_recent_conversations(limit, relevance):
+    flush_writes()
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            query = """
+            execute_prepared(
+                cur,
+                "recent_conversations",
+                """
                 SELECT c.*, f.feedback
                 FROM conversations c
                 LEFT JOIN feedback f ON c.id = f.conversation_id
-            """
-            if relevance:
-                query += f" WHERE c.relevance = '{relevance}'"
-            query += " ORDER BY c.timestamp DESC LIMIT %s"
-
-            cur.execute(query, (limit,))
+                WHERE $2::text IS NULL OR c.relevance = $2::text
+                ORDER BY c.timestamp DESC LIMIT $1::integer
+            """,
+                (limit, relevance),
+            )
             return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def get_feedback_stats():
-    conn = get_db_connection()
-    try:
+    return cached_read("feedback_stats", load_feedback_stats)
+
+
+def load_feedback_stats():
+    flush_writes()
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT 
-                    SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
-                    SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
-                FROM feedback
-            """)
-            return cur.fetchone()
-    finally:
-        conn.close()
\ No newline at end of file
+            execute_prepared(
+                cur,
+                "feedback_stats",
+                "SELECT thumbs_up, thumbs_down FROM feedback_totals",
+                (),
+            )
+            row = cur.fetchone()
+            return {"thumbs_up": row["thumbs_up"] if row else 0, "thumbs_down": row["thumbs_down"] if row else 0}
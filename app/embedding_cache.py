@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class EmbeddingCache:
+    # Content-addressed store of document embeddings: vectors live in a
+    # memory-mapped float32 matrix, index.json maps a text hash to its row.
+    # The whole cache is dropped when the model name or dimension changes.
+
+    def __init__(self, cache_dir, model_name, dims, initial_capacity=1024):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dims = dims
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.rows = {}
+        self.capacity = 0
+        self.vectors = None
+        if os.path.exists(self.index_path) and os.path.exists(self.vectors_path):
+            with open(self.index_path, "r") as f:
+                meta = json.load(f)
+            if meta.get("model") == model_name and meta.get("dims") == dims:
+                self.rows = meta["rows"]
+                self.capacity = os.path.getsize(self.vectors_path) // (dims * 4)
+            else:
+                print(f"Embedding cache was built with {meta.get('model')}, invalidating it")
+        if self.capacity == 0:
+            self.rows = {}
+            with open(self.vectors_path, "wb"):
+                pass
+        self._resize(max(self.capacity, initial_capacity))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def key(self, text):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_name.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return np.array(self.vectors[row])
+
+    def put_many(self, keys, vectors):
+        new_keys = [key for key in keys if key not in self.rows]
+        needed = len(self.rows) + len(new_keys)
+        if needed > self.capacity:
+            self._resize(max(needed, self.capacity * 2))
+        for key, vector in zip(keys, vectors):
+            row = self.rows.get(key)
+            if row is None:
+                row = len(self.rows)
+                self.rows[key] = row
+            self.vectors[row] = vector
+
+    def save(self):
+        self.vectors.flush()
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"model": self.model_name, "dims": self.dims, "rows": self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _resize(self, capacity):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(capacity * self.dims * 4)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dims))
+        self.capacity = capacity
@@ -3,7 +3,7 @@ import random
 import uuid
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from db import save_conversation, save_feedback
+from db import save_conversation, save_feedback, conversation_row, feedback_row, bulk_insert
 import psycopg2
 import os
 from dotenv import load_dotenv
@@ -62,6 +62,8 @@ SAMPLE_ANSWERS = [
     "This is not related to cooking. To get a summary of the latest tech news, check out tech news websites or apps."
 ]
 
+BULK_INSERT_SIZE = 5000
+
 MODELS = ["ollama/phi3", "openai/gpt-3.5-turbo", "openai/gpt-4o", "openai/gpt-4o-mini"]
 RELEVANCE = ["RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"]
 
@@ -77,6 +79,8 @@ def get_db_connection():
 def generate_synthetic_data(start_time, end_time):
     current_time = start_time
     conversation_count = 0
+    conversations = []
+    feedback_rows = []
     print(f"Starting historical data generation from {start_time} to {end_time}")
     while current_time < end_time:
         conversation_id = str(uuid.uuid4())
@@ -105,23 +109,21 @@ def generate_synthetic_data(start_time, end_time):
             "openai_cost": openai_cost,
         }
 
-        save_conversation(conversation_id, question, answer_data, current_time)
-        print(
-            f"Saved conversation: ID={conversation_id}, Time={current_time}, Model={model}"
-        )
+        conversations.append(conversation_row(conversation_id, question, answer_data, current_time))
 
         if random.random() < 0.7:
             feedback = 1 if random.random() < 0.8 else -1
-            save_feedback(conversation_id, feedback, current_time)
-            print(
-                f"Saved feedback for conversation {conversation_id}: {'Positive' if feedback > 0 else 'Negative'}"
-            )
+            feedback_rows.append(feedback_row(conversation_id, feedback, current_time))
 
         current_time += timedelta(minutes=random.randint(1, 15))
         conversation_count += 1
-        if conversation_count % 10 == 0:
+        if len(conversations) >= BULK_INSERT_SIZE:
+            bulk_insert(conversations, feedback_rows)
+            conversations, feedback_rows = [], []
             print(f"Generated {conversation_count} conversations so far...")
 
+    bulk_insert(conversations, feedback_rows)
+
     print(
         f"Historical data generation complete. Total conversations: {conversation_count}"
     )
@@ -0,0 +1,118 @@
+import os
+import re
+import numpy as np
+from recipe_loader import parse_list
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+MAX_PHRASE_WORDS = 3
+
+
+def singular(word):
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("oes", "ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def normalize_words(text):
+    return [singular(word) for word in WORD_PATTERN.findall(text.lower())]
+
+
+def ingredient_keywords(ingredients):
+    # Each ingredient contributes its normalized phrase and its head noun,
+    # so "cherry tomatoes" is found by both "cherry tomato" and "tomato".
+    keywords = set()
+    for ingredient in parse_list(ingredients, ","):
+        words = normalize_words(str(ingredient))
+        if words:
+            keywords.add(" ".join(words))
+            keywords.add(words[-1])
+    return sorted(keywords)
+
+
+class IngredientIndexWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.doc_ids = []
+        self.n_ingredients = []
+        self.postings = {}
+
+    def add(self, doc_id, keywords, n_ingredients):
+        row = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.n_ingredients.append(n_ingredients or 0)
+        for keyword in keywords:
+            self.postings.setdefault(keyword, []).append(row)
+
+    def close(self):
+        vocabulary = sorted(self.postings)
+        lengths = [len(self.postings[keyword]) for keyword in vocabulary]
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        postings = np.fromiter(
+            (row for keyword in vocabulary for row in self.postings[keyword]), dtype=np.int32, count=int(offsets[-1])
+        )
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            vocabulary=np.array(vocabulary, dtype=str),
+            offsets=offsets,
+            postings=postings,
+            doc_ids=np.array(self.doc_ids, dtype=str),
+            n_ingredients=np.array(self.n_ingredients, dtype=np.int32),
+        )
+        os.replace(tmp_path, self.path)
+        print(f"Ingredient index '{self.path}' written with {len(vocabulary)} keywords for {len(self.doc_ids)} recipes")
+
+
+class IngredientIndex:
+    # Posting lists of recipe rows per ingredient keyword, ranked by how many
+    # of the requested ingredients a recipe uses and then by how few it needs.
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.offsets = data["offsets"]
+        self.postings = data["postings"]
+        self.doc_ids = data["doc_ids"]
+        self.n_ingredients = data["n_ingredients"]
+        self.vocabulary = {keyword: i for i, keyword in enumerate(data["vocabulary"].tolist())}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def parse_query(self, query):
+        # Greedy longest match of the query's word n-grams against the vocabulary.
+        words = normalize_words(query)
+        found = []
+        i = 0
+        while i < len(words):
+            for size in range(min(MAX_PHRASE_WORDS, len(words) - i), 0, -1):
+                phrase = " ".join(words[i:i + size])
+                if phrase in self.vocabulary:
+                    if phrase not in found:
+                        found.append(phrase)
+                    i += size
+                    break
+            else:
+                i += 1
+        return found
+
+    def posting_list(self, keyword):
+        i = self.vocabulary[keyword]
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def search(self, keywords, size=50):
+        if not keywords:
+            return []
+        matched = np.bincount(
+            np.concatenate([self.posting_list(keyword) for keyword in keywords]), minlength=len(self.doc_ids)
+        )
+        rows = np.flatnonzero(matched)
+        rows = rows[np.lexsort((self.n_ingredients[rows], -matched[rows]))][:size]
+        return [(str(self.doc_ids[row]), int(matched[row]) / len(keywords)) for row in rows]
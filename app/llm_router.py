@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+import openai
+
+# Worth retrying on the same model; any other API error moves straight on to
+# the next model in the fallback chain.
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+MAX_RETRY_AFTER = 30
+
+
+class LLMUnavailableError(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    # Requests per minute with bursts of up to `capacity` requests.
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(rate_per_minute / 6.0, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        # Takes a token and returns how long to wait until it is due, or None
+        # without taking one when that would be longer than max_wait.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures and lets a single
+    # trial request through once `reset_timeout` seconds have passed.
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        # Returns the state the request was admitted in, "closed" or
+        # "half_open" for the single trial, or None when it is refused.
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return state
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return state
+            return None
+
+    def release(self):
+        # Gives back a half-open trial that ended without a verdict on the
+        # provider's health, so the next request can take it.
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+def retry_after(error, default):
+    response = getattr(error, "response", None)
+    try:
+        return min(float(response.headers["retry-after"]), MAX_RETRY_AFTER)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
+
+
+class LLMRouter:
+    # Sends a request to the chosen model and, when it is rate limited,
+    # failing or its circuit is open, down the fallback chain. request(model)
+    # performs the actual call; the route dict returned with its result says
+    # which model answered and what it took to get there.
+    # fallback_chain is ordered from the most to the least expensive model, a
+    # request only ever falls back to models after the one chosen. Models
+    # outside it fall back to the ones listed for them in fallbacks, if any.
+
+    def __init__(self, fallback_chain, rate_limits, default_rpm, max_retries=2, initial_backoff=1.0,
+                 max_rate_limit_wait=10.0, failure_threshold=5, reset_timeout=30.0, fallbacks=None):
+        self.fallback_chain = fallback_chain
+        self.fallbacks = fallbacks or {}
+        self.rate_limits = rate_limits
+        self.default_rpm = default_rpm
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.buckets = {}
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def chain(self, model_choice):
+        if model_choice in self.fallbacks:
+            return [model_choice] + self.fallbacks[model_choice]
+        if model_choice in self.fallback_chain:
+            return self.fallback_chain[self.fallback_chain.index(model_choice):]
+        return [model_choice]
+
+    def bucket(self, model):
+        with self._lock:
+            if model not in self.buckets:
+                self.buckets[model] = TokenBucket(self.rate_limits.get(model, self.default_rpm))
+            return self.buckets[model]
+
+    def breaker(self, model):
+        with self._lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.breakers[model]
+
+    def stats(self):
+        with self._lock:
+            return {model: breaker.state for model, breaker in self.breakers.items()}
+
+    async def call_async(self, model_choice, request):
+        route = {"model": None, "attempts": 0, "errors": 0, "latency": 0.0, "error": None}
+        for model in self.chain(model_choice):
+            for attempt in range(self.max_retries + 1):
+                admitted = self._admit(model, route)
+                if admitted is None:
+                    break
+                wait, state = admitted
+
+                try:
+                    await asyncio.sleep(wait)
+                    route["attempts"] += 1
+                    start_time = time.time()
+                    result = await request(model)
+                except RETRYABLE_ERRORS as e:
+                    self._record_error(route, model, e)
+                    error = e
+                except openai.APIError as e:
+                    # Rejected requests say nothing about the provider's health.
+                    self._record_error(route, model, e, trip_breaker=False)
+                    break
+                else:
+                    self.breaker(model).record_success()
+                    route.update(model=model, latency=time.time() - start_time)
+                    return result, route
+                finally:
+                    # A half-open trial that was rejected, cancelled or failed
+                    # with an unexpected error must not keep the circuit shut.
+                    # After record_success or record_failure this is a no-op.
+                    if state == "half_open":
+                        self.breaker(model).release()
+                if attempt < self.max_retries:
+                    await asyncio.sleep(retry_after(error, self.initial_backoff * 2 ** attempt))
+        raise LLMUnavailableError(f"No model could answer for {model_choice}, last error: {route['error']}")
+
+    def _admit(self, model, route):
+        # Seconds to wait before calling model and the breaker state it was
+        # admitted in, or None to move on to the next one. The breaker is
+        # asked first so calls it refuses do not use up rate budget.
+        breaker = self.breaker(model)
+        state = breaker.allow()
+        if state is None:
+            route["error"] = f"{model}: circuit open"
+            return None
+        wait = self.bucket(model).reserve(self.max_rate_limit_wait)
+        if wait is None:
+            if state == "half_open":
+                breaker.release()
+            route["error"] = f"{model}: rate limited"
+            return None
+        return wait, state
+
+    def _record_error(self, route, model, error, trip_breaker=True):
+        if trip_breaker:
+            self.breaker(model).record_failure()
+        route["errors"] += 1
+        route["error"] = f"{model}: {type(error).__name__}"
+        print(f"LLM call to {model} failed: {error!r}", flush=True)
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+import numpy as np
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeLLMServer:
+    # OpenAI-compatible /v1/chat/completions endpoint (Ollama serves the same
+    # API) that answers after a configurable delay with configurable token
+    # counts, optionally failing a share of requests with 429.
+
+    def __init__(self, host="127.0.0.1", port=0, first_token_latency=0.3, token_latency=0.01,
+                 completion_tokens=150, error_rate=0.0):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        handler = type("Handler", (FakeLLMHandler,), {"server_stub": self})
+        self.httpd = StubHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-llm", daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server_stub
+        stub.count_request()
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            return self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+        if random.random() < stub.error_rate:
+            return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                                  {"retry-after": "0.1"})
+
+        prompt = " ".join(message.get("content", "") for message in request.get("messages", []))
+        if "Generated Answer:" in prompt:
+            answer = json.dumps({"Relevance": "RELEVANT", "Explanation": "Stubbed evaluation"})
+        else:
+            answer = " ".join(["recipe"] * stub.completion_tokens)
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": stub.completion_tokens,
+            "total_tokens": len(prompt) // 4 + stub.completion_tokens,
+        }
+
+        time.sleep(stub.first_token_latency)
+        if request.get("stream"):
+            self.stream(request, answer, usage)
+        else:
+            time.sleep(stub.token_latency * stub.completion_tokens)
+            self.send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def stream(self, request, answer, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send(payload):
+            self.wfile.write(f"data: {payload}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for word in answer.split(" "):
+            send(json.dumps({
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }))
+            time.sleep(self.server_stub.token_latency)
+        if request.get("stream_options", {}).get("include_usage"):
+            send(json.dumps({
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [],
+                "usage": usage,
+            }))
+        send("[DONE]")
+        self.close_connection = True
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def synthetic_recipes(count, seed=0):
+    rng = random.Random(seed)
+    ingredients = ["chicken", "rice", "tomato", "pasta", "garlic", "onion", "beef", "potato", "cheese",
+                   "egg", "spinach", "mushroom", "carrot", "salmon", "tofu", "lentil", "basil", "lemon"]
+    recipes = []
+    for i in range(count):
+        picked = rng.sample(ingredients, rng.randint(3, 8))
+        recipes.append({
+            "id": i,
+            "name": f"{picked[0]} and {picked[1]} bake {i}",
+            "description": f"A simple dish with {', '.join(picked)}.",
+            "ingredients": str(picked),
+            "steps": str([f"step {n + 1}" for n in range(rng.randint(3, 12))]),
+            "tags": str(["30-minutes-or-less" if rng.random() < 0.5 else "60-minutes-or-less"]),
+            "n_ingredients": len(picked),
+            "n_steps": rng.randint(3, 12),
+        })
+    return recipes
+
+
+class InMemorySearch:
+    # Answers the search bodies assistant.py sends (multi_match, knn and ids
+    # lookups) from recipes held in memory, with Elasticsearch-shaped responses.
+    # Constraint filters other than ids are ignored.
+
+    def __init__(self, recipes, dims=384, latency=0.0, seed=0):
+        self.latency = latency
+        self.docs = {str(doc["id"]): doc for doc in recipes}
+        self.ids = list(self.docs)
+        self.terms = [set(WORD_PATTERN.findall(" ".join(str(value) for value in doc.values()).lower()))
+                      for doc in self.docs.values()]
+        vectors = np.random.default_rng(seed).normal(size=(len(self.ids), dims)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    @classmethod
+    def from_documents(cls, documents, limit, **kwargs):
+        return cls(list(islice(documents, limit)), **kwargs)
+
+    def respond(self, body):
+        start_time = time.time()
+        size = body.get("size", 10)
+        if "knn" in body:
+            scores = self.vectors @ np.asarray(body["knn"]["query_vector"], dtype=np.float32)
+            top = np.argsort(-scores)[:size]
+            ranked = [(self.ids[i], float(scores[i])) for i in top]
+        else:
+            query = body.get("query", {}).get("bool", {})
+            ids = [f["ids"]["values"] for f in query.get("filter", []) if isinstance(f, dict) and "ids" in f]
+            if ids:
+                ranked = [(doc_id, 1.0) for doc_id in ids[0] if doc_id in self.docs][:size]
+            else:
+                words = set(WORD_PATTERN.findall(query.get("must", {}).get("multi_match", {}).get("query", "").lower()))
+                scores = [(len(words & terms), doc_id) for doc_id, terms in zip(self.ids, self.terms)]
+                ranked = [(doc_id, float(score)) for score, doc_id in sorted(scores, reverse=True)[:size] if score]
+        hits = [{"_id": doc_id, "_score": score, "_source": self.docs[doc_id]} for doc_id, score in ranked]
+        return {"took": int((time.time() - start_time) * 1000), "hits": {"hits": hits}}
+
+    def search(self, index=None, body=None, **kwargs):
+        time.sleep(self.latency)
+        return self.respond(body)
+
+
+class AsyncInMemorySearch:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def search(self, index=None, body=None, **kwargs):
+        await asyncio.sleep(self.backend.latency)
+        return self.backend.respond(body)
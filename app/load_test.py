@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from db import get_recent_conversations
+from generate_data import SAMPLE_QUESTIONS
+from load_stubs import FakeLLMServer, InMemorySearch, AsyncInMemorySearch, synthetic_recipes
+from recipe_loader import iter_recipes
+
+# A request is considered saturated once adding load buys less than this much
+# extra throughput while its p95 latency keeps growing.
+SATURATION_THROUGHPUT_GAIN = 0.1
+SATURATION_LATENCY_GROWTH = 0.5
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def load_questions(path, recorded):
+    questions = list(SAMPLE_QUESTIONS)
+    if path:
+        with open(path, "r") as f:
+            questions += [line.strip() for line in f if line.strip()]
+    if recorded:
+        questions += [row["question"] for row in get_recent_conversations(limit=recorded)]
+    return questions
+
+
+def run_request(assistant, question, model_choice, search_type, with_db):
+    conversation_id = str(uuid.uuid4()) if with_db else None
+    start_time = time.time()
+    try:
+        answer_data = assistant.get_answer(question, model_choice, search_type, conversation_id=conversation_id)
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__, "latency": time.time() - start_time}
+    latency = time.time() - start_time
+    stages = {
+        "retrieval": answer_data.get("retrieval_time", 0.0),
+        "llm": answer_data.get("llm_latency", 0.0),
+    }
+    # Whatever is not retrieval or the LLM call: encoding, cache lookup and
+    # waiting for a pipeline slot.
+    stages["queue_and_encode"] = max(latency - stages["retrieval"] - answer_data.get("response_time", 0.0), 0.0)
+    return {"ok": True, "latency": latency, "stages": stages, "llm_errors": answer_data.get("llm_errors", 0)}
+
+
+def closed_loop(call, users, duration, think_time):
+    # Each user sends a request, waits for the answer and thinks before the next one.
+    results = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def user():
+        while time.time() < deadline:
+            result = call()
+            with lock:
+                results.append(result)
+            time.sleep(random.expovariate(1.0 / think_time) if think_time > 0 else 0)
+
+    threads = [threading.Thread(target=user, daemon=True) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def open_loop(call, rate, duration, max_in_flight):
+    # Poisson arrivals at `rate` requests per second, regardless of how fast answers come back.
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        deadline = time.time() + duration
+        next_arrival = time.time()
+        while next_arrival < deadline:
+            time.sleep(max(next_arrival - time.time(), 0))
+            futures.append(executor.submit(call))
+            next_arrival += random.expovariate(rate)
+    return [future.result() for future in futures]
+
+
+def summarize(level, results, elapsed):
+    ok = [result for result in results if result["ok"]]
+    errors = {}
+    for result in results:
+        if not result["ok"]:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    summary = {
+        "level": level,
+        "requests": len(results),
+        "completed": len(ok),
+        "errors": errors,
+        "llm_retries": sum(result["llm_errors"] for result in ok),
+        "throughput_rps": len(ok) / max(elapsed, 1e-9),
+        "latency_s": percentiles([result["latency"] for result in ok]),
+        "stages_s": {},
+    }
+    for stage in ("queue_and_encode", "retrieval", "llm"):
+        summary["stages_s"][stage] = percentiles([result["stages"][stage] for result in ok])
+    return summary
+
+
+def find_saturation(levels):
+    # First load level where throughput stops scaling while latency keeps
+    # climbing; the stage whose p95 grew the most is named as the bottleneck.
+    for previous, current in zip(levels, levels[1:]):
+        gain = current["throughput_rps"] / max(previous["throughput_rps"], 1e-9) - 1
+        growth = current["latency_s"]["p95"] / max(previous["latency_s"]["p95"], 1e-9) - 1
+        if gain < SATURATION_THROUGHPUT_GAIN and growth > SATURATION_LATENCY_GROWTH:
+            bottleneck = max(
+                current["stages_s"],
+                key=lambda stage: current["stages_s"][stage]["p95"] - previous["stages_s"][stage]["p95"],
+            )
+            return {"level": current["level"], "previous_level": previous["level"], "bottleneck_stage": bottleneck}
+    return None
+
+
+def setup_stubs(args):
+    # Must run before assistant is imported: its clients read these on import.
+    server = None
+    if args.llm == "stub":
+        server = FakeLLMServer(
+            first_token_latency=args.llm_latency,
+            token_latency=args.llm_token_latency,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.llm_error_rate,
+        ).start()
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["OPENAI_API_KEY"] = "stub"
+        os.environ["OLLAMA_URL"] = server.base_url
+        print(f"Fake LLM server listening on {server.base_url}")
+    if not args.semantic_cache:
+        os.environ["SEMANTIC_CACHE_ENABLED"] = "false"
+    if not args.with_db:
+        # Traces are saved to Postgres, which a run without --with-db must not need.
+        os.environ["TRACING_ENABLED"] = "false"
+    return server
+
+
+def plug_search_backend(assistant, args):
+    if args.search != "stub":
+        return
+    if os.path.exists(args.recipes):
+        backend = InMemorySearch.from_documents(iter_recipes(args.recipes), args.recipe_limit, latency=args.search_latency)
+    else:
+        backend = InMemorySearch(synthetic_recipes(args.recipe_limit), latency=args.search_latency)
+    assistant.async_es_client.set(AsyncInMemorySearch(backend))
+    print(f"In-memory search backend holds {len(backend.ids)} recipes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the get_answer request path")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 50, 200],
+                        help="closed-loop concurrent users, one stage per value")
+    parser.add_argument("--rate", type=float, nargs="+",
+                        help="open-loop arrival rates in requests/s, used instead of --users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per stage")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between a user's requests")
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    parser.add_argument("--model", default="openai/gpt-4o-mini")
+    parser.add_argument("--search-type", choices=["Text", "Vector", "Hybrid"], default="Hybrid")
+    parser.add_argument("--questions", help="extra questions, one per line")
+    parser.add_argument("--recorded", type=int, default=0, help="also replay the N most recent recorded questions")
+    parser.add_argument("--with-db", action="store_true", help="save conversations and evaluate relevance")
+    parser.add_argument("--semantic-cache", action="store_true")
+    parser.add_argument("--llm", choices=["stub", "real"], default="stub")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub seconds to first token")
+    parser.add_argument("--llm-token-latency", type=float, default=0.01, help="stub seconds per completion token")
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of stub requests answered with 429")
+    parser.add_argument("--search", choices=["stub", "real"], default="stub")
+    parser.add_argument("--search-latency", type=float, default=0.005)
+    parser.add_argument("--recipes", default=os.getenv("RECIPES_PATH", "recipes.json"))
+    parser.add_argument("--recipe-limit", type=int, default=10000)
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+
+    server = setup_stubs(args)
+    import assistant
+    plug_search_backend(assistant, args)
+    print(f"Startup: {assistant.startup_report()}")
+
+    questions = load_questions(args.questions, args.recorded)
+
+    def call():
+        return run_request(assistant, random.choice(questions), args.model, args.search_type, args.with_db)
+
+    levels = []
+    for level in args.rate or args.users:
+        print(f"Running {'rate' if args.rate else 'users'}={level} for {args.duration:.0f}s...")
+        start_time = time.time()
+        if args.rate:
+            results = open_loop(call, level, args.duration, args.max_in_flight)
+        else:
+            results = closed_loop(call, level, args.duration, args.think_time)
+        summary = summarize(level, results, time.time() - start_time)
+        levels.append(summary)
+        print(
+            f"  {summary['throughput_rps']:.1f} req/s  p50={summary['latency_s']['p50']:.2f}s  "
+            f"p95={summary['latency_s']['p95']:.2f}s  p99={summary['latency_s']['p99']:.2f}s  "
+            f"errors={sum(summary['errors'].values())}"
+        )
+
+    report = {
+        "mode": "open_loop" if args.rate else "closed_loop",
+        "model": args.model,
+        "search_type": args.search_type,
+        "llm": args.llm,
+        "search": args.search,
+        "levels": levels,
+        "saturation": find_saturation(levels),
+        "llm_circuits": assistant.llm_router.stats(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saturation: {report['saturation']}")
+    print(f"Results written to {args.output}")
+    if server is not None:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+import os
+import time
+import psycopg2
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONVERSATION_PARTITION_MONTHS_AHEAD = int(os.getenv("CONVERSATION_PARTITION_MONTHS_AHEAD", "12"))
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_MAX_ATTEMPTS = int(os.getenv("MIGRATION_MAX_ATTEMPTS", "10"))
+MIGRATION_ADVISORY_LOCK = 7203911
+
+
+def add_column(cur, table, column_definition):
+    # Columns without a default or with a constant one are added as a catalog
+    # change only; lock_timeout keeps the ALTER from queueing behind long
+    # transactions and blocking everyone else while it waits.
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column_definition}")
+
+
+def create_base_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback (
+            id SERIAL PRIMARY KEY,
+            conversation_id TEXT REFERENCES conversations(id),
+            feedback INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    """)
+
+
+def add_answer_metadata_columns(cur):
+    add_column(cur, "conversations", "time_to_first_token FLOAT")
+    add_column(cur, "conversations", "cache_hit BOOLEAN NOT NULL DEFAULT FALSE")
+    add_column(cur, "conversations", "cache_saved_cost FLOAT NOT NULL DEFAULT 0")
+
+
+def create_answer_cache(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            id SERIAL PRIMARY KEY,
+            question TEXT NOT NULL,
+            embedding REAL[] NOT NULL,
+            model_used TEXT NOT NULL,
+            search_type TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            last_hit_at TIMESTAMP WITH TIME ZONE
+        )
+    """)
+
+
+def upgrade_monitoring_schema(cur):
+    # Idempotent upgrade of an existing conversations/feedback schema: monthly
+    # partitions, indexes for the app and dashboard queries, and per-minute
+    # rollup tables kept current by triggers. Existing rows are preserved.
+    partition_conversations(cur)
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp DESC)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_relevance_timestamp ON conversations (relevance, timestamp DESC)"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_feedback_conversation_id ON feedback (conversation_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_feedback_timestamp ON feedback (timestamp)")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_stats_minute (
+            minute TIMESTAMP WITH TIME ZONE NOT NULL,
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            conversations INTEGER NOT NULL DEFAULT 0,
+            response_time_sum FLOAT NOT NULL DEFAULT 0,
+            prompt_tokens BIGINT NOT NULL DEFAULT 0,
+            completion_tokens BIGINT NOT NULL DEFAULT 0,
+            total_tokens BIGINT NOT NULL DEFAULT 0,
+            eval_total_tokens BIGINT NOT NULL DEFAULT 0,
+            openai_cost FLOAT NOT NULL DEFAULT 0,
+            cache_hits INTEGER NOT NULL DEFAULT 0,
+            cache_saved_cost FLOAT NOT NULL DEFAULT 0,
+            PRIMARY KEY (minute, model_used, relevance)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback_stats_minute (
+            minute TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+            thumbs_up INTEGER NOT NULL DEFAULT 0,
+            thumbs_down INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rollup_conversation() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE conversation_stats_minute SET
+                    conversations = conversations - 1,
+                    response_time_sum = response_time_sum - OLD.response_time,
+                    prompt_tokens = prompt_tokens - OLD.prompt_tokens,
+                    completion_tokens = completion_tokens - OLD.completion_tokens,
+                    total_tokens = total_tokens - OLD.total_tokens,
+                    eval_total_tokens = eval_total_tokens - OLD.eval_total_tokens,
+                    openai_cost = openai_cost - OLD.openai_cost,
+                    cache_hits = cache_hits - OLD.cache_hit::int,
+                    cache_saved_cost = cache_saved_cost - OLD.cache_saved_cost
+                WHERE minute = date_trunc('minute', OLD.timestamp)
+                    AND model_used = OLD.model_used
+                    AND relevance = OLD.relevance;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO conversation_stats_minute AS s (
+                    minute, model_used, relevance, conversations, response_time_sum, prompt_tokens,
+                    completion_tokens, total_tokens, eval_total_tokens, openai_cost, cache_hits, cache_saved_cost
+                ) VALUES (
+                    date_trunc('minute', NEW.timestamp), NEW.model_used, NEW.relevance, 1, NEW.response_time,
+                    NEW.prompt_tokens, NEW.completion_tokens, NEW.total_tokens, NEW.eval_total_tokens,
+                    NEW.openai_cost, NEW.cache_hit::int, NEW.cache_saved_cost
+                )
+                ON CONFLICT (minute, model_used, relevance) DO UPDATE SET
+                    conversations = s.conversations + 1,
+                    response_time_sum = s.response_time_sum + EXCLUDED.response_time_sum,
+                    prompt_tokens = s.prompt_tokens + EXCLUDED.prompt_tokens,
+                    completion_tokens = s.completion_tokens + EXCLUDED.completion_tokens,
+                    total_tokens = s.total_tokens + EXCLUDED.total_tokens,
+                    eval_total_tokens = s.eval_total_tokens + EXCLUDED.eval_total_tokens,
+                    openai_cost = s.openai_cost + EXCLUDED.openai_cost,
+                    cache_hits = s.cache_hits + EXCLUDED.cache_hits,
+                    cache_saved_cost = s.cache_saved_cost + EXCLUDED.cache_saved_cost;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rollup_feedback() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE feedback_stats_minute SET
+                    thumbs_up = thumbs_up - (OLD.feedback > 0)::int,
+                    thumbs_down = thumbs_down - (OLD.feedback < 0)::int
+                WHERE minute = date_trunc('minute', OLD.timestamp);
+                RETURN NULL;
+            END IF;
+            INSERT INTO feedback_stats_minute AS s (minute, thumbs_up, thumbs_down)
+            VALUES (date_trunc('minute', NEW.timestamp), (NEW.feedback > 0)::int, (NEW.feedback < 0)::int)
+            ON CONFLICT (minute) DO UPDATE SET
+                thumbs_up = s.thumbs_up + EXCLUDED.thumbs_up,
+                thumbs_down = s.thumbs_down + EXCLUDED.thumbs_down;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+    # Rebuild the rollups from scratch so they match existing history, then
+    # keep them current with triggers.
+    cur.execute("DROP TRIGGER IF EXISTS conversations_rollup ON conversations")
+    cur.execute("DROP TRIGGER IF EXISTS feedback_rollup ON feedback")
+    cur.execute("TRUNCATE conversation_stats_minute, feedback_stats_minute")
+    cur.execute("""
+        INSERT INTO conversation_stats_minute
+        SELECT date_trunc('minute', timestamp), model_used, relevance, COUNT(*), SUM(response_time),
+            SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), SUM(eval_total_tokens),
+            SUM(openai_cost), SUM(cache_hit::int), SUM(cache_saved_cost)
+        FROM conversations
+        GROUP BY 1, 2, 3
+    """)
+    cur.execute("""
+        INSERT INTO feedback_stats_minute
+        SELECT date_trunc('minute', timestamp), SUM((feedback > 0)::int), SUM((feedback < 0)::int)
+        FROM feedback
+        GROUP BY 1
+    """)
+    cur.execute("""
+        CREATE TRIGGER conversations_rollup AFTER INSERT OR UPDATE OR DELETE ON conversations
+        FOR EACH ROW EXECUTE FUNCTION rollup_conversation()
+    """)
+    cur.execute("""
+        CREATE TRIGGER feedback_rollup AFTER INSERT OR DELETE ON feedback
+        FOR EACH ROW EXECUTE FUNCTION rollup_feedback()
+    """)
+
+
+def partition_conversations(cur):
+    # A partitioned table's primary key must include the partition column, so
+    # the key becomes (id, timestamp) and feedback loses its foreign key.
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'conversations'::regclass")
+    if cur.fetchone()[0] == "p":
+        ensure_conversation_partitions(cur)
+        return
+
+    cur.execute("ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_conversation_id_fkey")
+    cur.execute("ALTER TABLE conversations RENAME TO conversations_unpartitioned")
+    cur.execute("ALTER TABLE conversations_unpartitioned RENAME CONSTRAINT conversations_pkey TO conversations_unpartitioned_pkey")
+    cur.execute("""
+        CREATE TABLE conversations (LIKE conversations_unpartitioned INCLUDING DEFAULTS)
+        PARTITION BY RANGE (timestamp)
+    """)
+    cur.execute("ALTER TABLE conversations ADD PRIMARY KEY (id, timestamp)")
+    cur.execute("CREATE TABLE conversations_default PARTITION OF conversations DEFAULT")
+
+    cur.execute("SELECT MIN(timestamp) FROM conversations_unpartitioned")
+    oldest = cur.fetchone()[0]
+    ensure_conversation_partitions(cur, since=oldest)
+    cur.execute("INSERT INTO conversations SELECT * FROM conversations_unpartitioned")
+    cur.execute("DROP TABLE conversations_unpartitioned")
+
+
+def ensure_conversation_partitions(cur, since=None, months_ahead=CONVERSATION_PARTITION_MONTHS_AHEAD):
+    now = datetime.now(timezone.utc)
+    start = since.astimezone(timezone.utc) if since else now
+    month = datetime(start.year, start.month, 1, tzinfo=timezone.utc)
+    last = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    for _ in range(months_ahead):
+        last = (last + timedelta(days=32)).replace(day=1)
+
+    while month <= last:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        name = f"conversations_{month:%Y_%m}"
+        cur.execute("SAVEPOINT create_partition")
+        try:
+            cur.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)",
+                (month, next_month),
+            )
+            cur.execute("RELEASE SAVEPOINT create_partition")
+        except psycopg2.Error as e:
+            # Rows for this month already landed in the default partition.
+            cur.execute("ROLLBACK TO SAVEPOINT create_partition")
+            print(f"Skipping partition {name}: {e}", flush=True)
+        month = next_month
+
+
+def add_retrieval_time_column(cur):
+    add_column(cur, "conversations", "retrieval_time FLOAT")
+
+
+def add_llm_route_columns(cur):
+    # model_used is the model that answered, requested_model the one picked in the UI.
+    add_column(cur, "conversations", "requested_model TEXT")
+    add_column(cur, "conversations", "llm_latency FLOAT")
+    add_column(cur, "conversations", "llm_attempts INTEGER")
+    add_column(cur, "conversations", "llm_errors INTEGER")
+    add_column(cur, "conversations", "llm_error TEXT")
+
+
+def create_trace_spans(cur):
+    # One row per pipeline stage; trace_id is the conversation id when there is one.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS trace_spans (
+            trace_id TEXT NOT NULL,
+            span_id TEXT NOT NULL,
+            parent_id TEXT,
+            name TEXT NOT NULL,
+            start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            duration_ms FLOAT NOT NULL,
+            status TEXT NOT NULL,
+            attributes JSONB NOT NULL DEFAULT '{}'
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_start_time_name ON trace_spans (start_time, name)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_trace_id ON trace_spans (trace_id)")
+
+
+def create_feedback_totals(cur):
+    # Single-row running totals, so the app reads its thumbs up/down counters
+    # without summing the per-minute rollups.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback_totals (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            thumbs_up BIGINT NOT NULL DEFAULT 0,
+            thumbs_down BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    # No feedback may land between the backfill and the new trigger.
+    cur.execute("LOCK TABLE feedback IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("""
+        INSERT INTO feedback_totals (id, thumbs_up, thumbs_down)
+        SELECT TRUE, COALESCE(SUM(thumbs_up), 0), COALESCE(SUM(thumbs_down), 0) FROM feedback_stats_minute
+        ON CONFLICT (id) DO UPDATE SET thumbs_up = EXCLUDED.thumbs_up, thumbs_down = EXCLUDED.thumbs_down
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rollup_feedback() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE feedback_stats_minute SET
+                    thumbs_up = thumbs_up - (OLD.feedback > 0)::int,
+                    thumbs_down = thumbs_down - (OLD.feedback < 0)::int
+                WHERE minute = date_trunc('minute', OLD.timestamp);
+                UPDATE feedback_totals SET
+                    thumbs_up = thumbs_up - (OLD.feedback > 0)::int,
+                    thumbs_down = thumbs_down - (OLD.feedback < 0)::int;
+                RETURN NULL;
+            END IF;
+            INSERT INTO feedback_stats_minute AS s (minute, thumbs_up, thumbs_down)
+            VALUES (date_trunc('minute', NEW.timestamp), (NEW.feedback > 0)::int, (NEW.feedback < 0)::int)
+            ON CONFLICT (minute) DO UPDATE SET
+                thumbs_up = s.thumbs_up + EXCLUDED.thumbs_up,
+                thumbs_down = s.thumbs_down + EXCLUDED.thumbs_down;
+            UPDATE feedback_totals SET
+                thumbs_up = thumbs_up + (NEW.feedback > 0)::int,
+                thumbs_down = thumbs_down + (NEW.feedback < 0)::int;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+# Ordered and append-only: never edit a migration once it has shipped, add a
+# new one instead.
+MIGRATIONS = [
+    (1, "create base tables", create_base_tables),
+    (2, "add answer metadata columns", add_answer_metadata_columns),
+    (3, "create answer cache", create_answer_cache),
+    (4, "partition conversations and add rollups", upgrade_monitoring_schema),
+    (5, "add retrieval time column", add_retrieval_time_column),
+    (6, "add llm route columns", add_llm_route_columns),
+    (7, "create trace spans", create_trace_spans),
+    (8, "create feedback totals", create_feedback_totals),
+]
+
+
+def applied_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def apply_migration(conn, version, name, migrate):
+    # Each migration runs in its own transaction and is retried when it
+    # cannot get its locks within MIGRATION_LOCK_TIMEOUT.
+    for attempt in range(1, MIGRATION_MAX_ATTEMPTS + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+                migrate(cur)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == MIGRATION_MAX_ATTEMPTS:
+                raise
+            print(f"Migration {version} is waiting for a lock, retrying (attempt {attempt})", flush=True)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def run_migrations(conn):
+    with conn.cursor() as cur:
+        # Serializes concurrent runners (several prep.py runs, app replicas).
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_ADVISORY_LOCK,))
+    try:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+        conn.commit()
+
+        for version, name, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            print(f"Applying migration {version}: {name}", flush=True)
+            apply_migration(conn, version, name, migrate)
+
+        with conn.cursor() as cur:
+            ensure_conversation_partitions(cur)
+        conn.commit()
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_ADVISORY_LOCK,))
+        conn.commit()
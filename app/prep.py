@@ -1,10 +1,21 @@
+import argparse
+import hashlib
 import json
+import random
+import time
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from elasticsearch import Elasticsearch, ConnectionError, ConnectionTimeout
+from elasticsearch.helpers import bulk, scan
 from tqdm.auto import tqdm
 from dotenv import load_dotenv
 from db import init_db
+from embedding_cache import EmbeddingCache
+from recipe_loader import iter_recipes, parse_list
+from vector_index import VectorIndexWriter
+from ingredient_index import IngredientIndexWriter, ingredient_keywords
 import os
 load_dotenv()
 
@@ -12,81 +23,453 @@ ELASTIC_URL = os.getenv("ELASTIC_URL_LOCAL")
 MODEL_NAME = os.getenv("MODEL_NAME")
 INDEX_NAME = os.getenv("INDEX_NAME")
 
-def fetch_documents():
-    print('Fetching documents...')
-    with open('recipes.json', 'r') as json_file:
-        documents = json.load(json_file)
-    return documents
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_THREADS = int(os.getenv("BULK_THREADS", "4"))
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "5"))
+BULK_INITIAL_BACKOFF = float(os.getenv("BULK_INITIAL_BACKOFF", "2"))
 
-def index_documents(es_client, documents, model):
-    print('Indexing documents...')
-    operations = []
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_CHUNK_SIZE = int(os.getenv("EMBED_CHUNK_SIZE", "4096"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+EMBED_FIELDS = ["name", "description", "ingredients", "steps", "tags"]
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+REINDEX_MODE = os.getenv("REINDEX_MODE", "incremental")
+RECIPES_PATH = os.getenv("RECIPES_PATH", "recipes.json")
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "ground_truth.csv")
+GROUND_TRUTH_SIZE = int(os.getenv("GROUND_TRUTH_SIZE", "200"))
+GROUND_TRUTH_SEED = 42
+# int8_hnsw needs Elasticsearch 8.12+, plain hnsw works on every 8.x release.
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "100"))
+# A copy of the vectors for the in-process retrieval backend (RETRIEVAL_BACKEND=local).
+LOCAL_VECTOR_INDEX = os.getenv("LOCAL_VECTOR_INDEX", "false").lower() == "true"
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_index")
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32")
+LOCAL_VECTOR_IVF_LISTS = int(os.getenv("LOCAL_VECTOR_IVF_LISTS", "0"))
+INGREDIENT_INDEX_PATH = os.getenv("INGREDIENT_INDEX_PATH", "ingredient_index.npz")
+LOCAL_VECTOR_FIELDS = ["id", "name", "description", "ingredients", "steps", "tags", "n_ingredients", "n_steps"]
+
+INDEX_SETTINGS = {
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 0
+    },
+    "mappings": {
+        "properties": {
+            "ingredients": {"type": "text"},
+            "steps": {"type": "text"},
+            "name": {"type": "text"},
+            "description": {"type": "text"},
+            "tags": {"type": "text"},
+            "n_ingredients": {"type": "integer"},
+            "n_steps": {"type": "integer"},
+            "id": {"type": "keyword"},
+            "ingredient_keywords": {"type": "keyword"},
+            "content_hash": {"type": "keyword"},
+            "text_vector": {
+                "type": "dense_vector",
+                "dims": 384,
+                "index": True,
+                "similarity": "cosine",
+                "index_options": {
+                    "type": VECTOR_INDEX_TYPE,
+                    "m": HNSW_M,
+                    "ef_construction": HNSW_EF_CONSTRUCTION,
+                },
+            },
+        }
+    }
+}
+
+def fetch_documents(path=RECIPES_PATH):
+    # Recipes are streamed from disk and flow through embedding and indexing
+    # one chunk at a time, so memory does not grow with the dataset.
+    print(f'Streaming documents from {path}...')
+    return with_ingredient_keywords(iter_recipes(path))
+
+
+def with_ingredient_keywords(documents):
     for doc in documents:
-        operations.append(doc)
+        doc["ingredient_keywords"] = ingredient_keywords(doc.get("ingredients"))
+        yield doc
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def report_throughput(stage, docs, seconds):
+    print(f"{stage}: {docs} docs in {seconds:.1f}s ({docs / max(seconds, 1e-9):.0f} docs/sec)")
+
+
+def document_text(doc):
+    parts = []
+    for field in EMBED_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, list):
+            value = ", ".join(str(item) for item in value)
+        if value:
+            parts.append(str(value))
+    return "\n".join(parts)
+
+
+def load_embedding_cache(model):
+    cache = EmbeddingCache(EMBEDDING_CACHE_DIR, MODEL_NAME, model.get_sentence_embedding_dimension())
+    print(f"Embedding cache '{EMBEDDING_CACHE_DIR}' holds {len(cache)} vectors")
+    return cache
+
+
+def embed_documents(documents, model, stats, cache):
+    # Documents are encoded a chunk at a time and handed on immediately,
+    # so only EMBED_CHUNK_SIZE vectors are ever held in memory. Recipes whose
+    # text is already in the cache are not encoded again.
+    pool = None
+    try:
+        for batch in chunked(documents, EMBED_CHUNK_SIZE):
+            start_time = time.time()
+            keys = [cache.key(document_text(doc)) for doc in batch]
+            vectors = [cache.get(key) for key in keys]
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+            if missing:
+                texts = [document_text(batch[i]) for i in missing]
+                if EMBED_WORKERS > 1 and pool is None:
+                    pool = model.start_multi_process_pool(["cpu"] * EMBED_WORKERS)
+                if pool is not None:
+                    encoded = model.encode_multi_process(
+                        texts, pool, batch_size=EMBED_BATCH_SIZE, normalize_embeddings=True
+                    )
+                else:
+                    encoded = model.encode(
+                        texts, batch_size=EMBED_BATCH_SIZE, normalize_embeddings=True, show_progress_bar=False
+                    )
+                cache.put_many([keys[i] for i in missing], encoded)
+                for i, vector in zip(missing, encoded):
+                    vectors[i] = vector
+
+            for doc, vector in zip(batch, vectors):
+                doc["text_vector"] = vector.tolist()
+            stats["embed"][0] += len(batch)
+            stats["embed"][1] += time.time() - start_time
+            stats["cache_hits"] += len(batch) - len(missing)
+            yield from batch
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+
+def content_hash(doc):
+    content = {key: value for key, value in doc.items() if key not in ("text_vector", "content_hash")}
+    serialized = json.dumps(content, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def with_content_hash(documents):
+    for doc in documents:
+        doc["content_hash"] = content_hash(doc)
+        yield doc
+
+
+def generate_actions(documents, index_name):
+    # The recipe id doubles as the document _id, so re-indexing a recipe
+    # overwrites it instead of adding a duplicate.
+    for doc in documents:
+        yield {"_index": index_name, "_id": str(doc["id"]), "_source": doc}
+
+
+def generate_delete_actions(doc_ids, index_name):
+    for doc_id in doc_ids:
+        yield {"_op_type": "delete", "_index": index_name, "_id": doc_id}
+
+
+@contextmanager
+def bulk_load_settings(es_client, index_name):
+    # Refreshing and replicating every chunk is wasted work while loading,
+    # so both are switched off and restored once the load is finished.
+    settings = es_client.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+    original = {
+        "refresh_interval": settings.get("refresh_interval"),
+        "number_of_replicas": settings.get("number_of_replicas", "1"),
+    }
+    es_client.indices.put_settings(
+        index=index_name,
+        settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+    try:
+        yield
+    finally:
+        es_client.indices.put_settings(index=index_name, settings={"index": original})
+        es_client.indices.refresh(index=index_name)
+
+
+def send_chunk(es_client, chunk):
+    # Documents rejected with 429 are retried by the bulk helper itself,
+    # transport failures of the whole request are retried here.
+    start_time = time.time()
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        try:
+            success, errors = bulk(
+                es_client,
+                chunk,
+                chunk_size=len(chunk),
+                max_retries=BULK_MAX_RETRIES,
+                initial_backoff=BULK_INITIAL_BACKOFF,
+                raise_on_error=False,
+            )
+            return success, errors, time.time() - start_time
+        except (ConnectionError, ConnectionTimeout) as e:
+            if attempt == BULK_MAX_RETRIES:
+                raise
+            delay = BULK_INITIAL_BACKOFF * 2 ** attempt
+            print(f"Bulk chunk failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
 
-    for doc in tqdm(operations, total=len(operations)):
-        es_client.index(index=INDEX_NAME, document=doc)
-    print(f"Indexed {len(documents)} documents")
+def bulk_index(es_client, actions, stats, chunk_size=BULK_CHUNK_SIZE, threads=BULK_THREADS):
+    indexed = 0
+    failed = []
+    pending = set()
+    progress = tqdm(unit="docs")
+
+    def collect(done):
+        nonlocal indexed
+        for future in done:
+            success, errors, elapsed = future.result()
+            indexed += success
+            failed.extend(errors)
+            stats["index"][0] += success + len(errors)
+            stats["index"][1] += elapsed / threads
+            progress.update(success + len(errors))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for chunk in chunked(actions, chunk_size):
+            # Keep only a few chunks in flight so the input is never read ahead of the cluster.
+            if len(pending) >= threads * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(send_chunk, es_client, chunk))
+        collect(pending)
+
+    progress.close()
+    return indexed, failed
+
+
+def index_documents(es_client, documents, model, index_name=INDEX_NAME, tune_settings=True):
+    print('Indexing documents...')
+    stats = {"embed": [0, 0.0], "index": [0, 0.0], "cache_hits": 0}
+    cache = load_embedding_cache(model)
+    start_time = time.time()
+    try:
+        with bulk_load_settings(es_client, index_name) if tune_settings else nullcontext():
+            embedded = embed_documents(documents, model, stats, cache)
+            indexed, failed = bulk_index(es_client, generate_actions(embedded, index_name), stats)
+    finally:
+        cache.save()
+    elapsed = time.time() - start_time
+
+    for error in failed[:10]:
+        print(f"Failed to index document: {error}")
+    count = es_client.count(index=index_name)["count"]
+    report_throughput("Embedding", *stats["embed"])
+    print(f"Embedding cache hits: {stats['cache_hits']}/{stats['embed'][0]}")
+    report_throughput("Bulk indexing", *stats["index"])
+    report_throughput("Pipeline", indexed, elapsed)
+    print(f"{len(failed)} documents failed, index '{index_name}' now holds {count} documents")
 
 
 def load_model():
+    # Imported here so benchmark.py can use the ground truth helpers without loading torch.
+    from sentence_transformers import SentenceTransformer
+
     print(f"Loading model: {MODEL_NAME}")
     return SentenceTransformer(MODEL_NAME)
 
-# def fetch_ground_truth():
-#     print("Fetching ground truth data...")
-#     relative_url = "03-vector-search/eval/ground-truth-data.csv"
-#     ground_truth_url = f"{BASE_URL}/{relative_url}?raw=1"
-#     df_ground_truth = pd.read_csv(ground_truth_url)
-#     df_ground_truth = df_ground_truth[
-#         df_ground_truth.course == "machine-learning-zoomcamp"
-#     ]
-#     ground_truth = df_ground_truth.to_dict(orient="records")
-#     print(f"Fetched {len(ground_truth)} ground truth records")
-#     return ground_truth
+def fetch_ground_truth(path=GROUND_TRUTH_PATH, size=GROUND_TRUTH_SIZE):
+    # (question, recipe id) pairs for benchmark.py. Generated once from a
+    # fixed sample of the recipes and kept on disk, so runs stay comparable.
+    if os.path.exists(path):
+        ground_truth = pd.read_csv(path, dtype={"id": str}).to_dict(orient="records")
+        print(f"Loaded {len(ground_truth)} ground truth records from {path}")
+        return ground_truth
+
+    print("Generating ground truth data...")
+    rng = random.Random(GROUND_TRUTH_SEED)
+    sample = []
+    for i, doc in enumerate(iter_recipes(RECIPES_PATH)):
+        # Reservoir sampling keeps a uniform sample without holding every recipe.
+        if len(sample) < size:
+            sample.append(doc)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                sample[j] = doc
+
+    ground_truth = []
+    for doc in sample:
+        ground_truth.extend(ground_truth_questions(doc, rng))
+    pd.DataFrame(ground_truth, columns=["question", "id", "question_type"]).to_csv(path, index=False)
+    print(f"Wrote {len(ground_truth)} ground truth records to {path}")
+    return ground_truth
+
+
+def ground_truth_questions(doc, rng):
+    doc_id = str(doc["id"])
+    questions = [{"question": f"How do I make {doc['name'].strip()}?", "id": doc_id, "question_type": "name"}]
+    ingredients = [item for item in parse_list(doc.get("ingredients"), ",") if item]
+    if len(ingredients) >= 3:
+        picked = rng.sample(ingredients, 3)
+        questions.append({
+            "question": f"I have {picked[0]}, {picked[1]} and {picked[2]}. What can I cook?",
+            "id": doc_id,
+            "question_type": "ingredients",
+        })
+    return questions
 
 
 def setup_elasticsearch():
     print("Setting up Elasticsearch...")
-    es_client = Elasticsearch("http://localhost:9200")
-
-    index_settings = {
-        "settings": {
-            "number_of_shards": 1,
-            "number_of_replicas": 0
-        },
-        "mappings": {
-            "properties": {
-                "ingredients": {"type": "text"},
-                "steps": {"type": "text"},
-                "name": {"type": "text"},
-                "description": {"type": "text"},
-                "tags": {"type": "text"},
-                "n_ingredients": {"type": "integer"},
-                "n_steps": {"type": "integer"},
-                "id": {"type": "keyword"},
-                "text_vector": {
-                    "type": "dense_vector",
-                    "dims": 384,
-                    "index": True,
-                    "similarity": "cosine"
-                },
-            }
-        }
-    }
+    return Elasticsearch("http://localhost:9200")
+
+
+def create_index(es_client):
+    index_name = f"{INDEX_NAME}-{time.strftime('%Y%m%d%H%M%S')}"
+    es_client.indices.create(index=index_name, body=INDEX_SETTINGS)
+    print(f"Elasticsearch index '{index_name}' created")
+    return index_name
+
+
+def swap_alias(es_client, index_name):
+    # Readers query INDEX_NAME, which is an alias; pointing it at the freshly
+    # built index is a single atomic update, so no query sees a partial index.
+    actions = [{"add": {"index": index_name, "alias": INDEX_NAME}}]
+    old_indices = []
+    if es_client.indices.exists_alias(name=INDEX_NAME):
+        old_indices = list(es_client.indices.get_alias(name=INDEX_NAME).keys())
+        actions += [{"remove": {"index": old, "alias": INDEX_NAME}} for old in old_indices]
+    elif es_client.indices.exists(index=INDEX_NAME):
+        # Index created before aliases were used, it is replaced in the same step.
+        actions.append({"remove_index": {"index": INDEX_NAME}})
+
+    es_client.indices.update_aliases(actions=actions)
+    print(f"Alias '{INDEX_NAME}' now points to '{index_name}'")
+    for old in old_indices:
+        es_client.indices.delete(index=old, ignore_unavailable=True)
+        print(f"Deleted previous index '{old}'")
+
+
+def rebuild_index(es_client, documents, model):
+    index_name = create_index(es_client)
+    index_documents(es_client, with_content_hash(documents), model, index_name=index_name)
+    swap_alias(es_client, index_name)
+
+
+def fetch_indexed_hashes(es_client):
+    print(f"Fetching content hashes from '{INDEX_NAME}'...")
+    hits = scan(es_client, index=INDEX_NAME, query={"query": {"match_all": {}}}, _source=["content_hash"])
+    return {hit["_id"]: hit["_source"].get("content_hash") for hit in hits}
+
+
+def changed_documents(documents, indexed_hashes, seen_ids):
+    for doc in documents:
+        doc_id = str(doc["id"])
+        seen_ids.add(doc_id)
+        doc["content_hash"] = content_hash(doc)
+        if indexed_hashes.get(doc_id) != doc["content_hash"]:
+            yield doc
+
+
+def update_index(es_client, documents, model):
+    if not es_client.indices.exists_alias(name=INDEX_NAME):
+        print(f"No alias '{INDEX_NAME}' found, running a full rebuild")
+        rebuild_index(es_client, documents, model)
+        return
+
+    # Indices created before a field was added to the mapping pick it up here,
+    # new fields can be added to an existing mapping without reindexing.
+    es_client.indices.put_mapping(
+        index=INDEX_NAME,
+        properties={"ingredient_keywords": INDEX_SETTINGS["mappings"]["properties"]["ingredient_keywords"]},
+    )
+    indexed_hashes = fetch_indexed_hashes(es_client)
+    seen_ids = set()
+    index_documents(
+        es_client,
+        changed_documents(documents, indexed_hashes, seen_ids),
+        model,
+        index_name=INDEX_NAME,
+        tune_settings=False,
+    )
+
+    removed = set(indexed_hashes) - seen_ids
+    if removed:
+        stats = {"index": [0, 0.0]}
+        deleted, failed = bulk_index(es_client, generate_delete_actions(removed, INDEX_NAME), stats)
+        print(f"Deleted {deleted} removed recipes, {len(failed)} failed")
+    es_client.indices.refresh(index=INDEX_NAME)
+
+
+def export_local_indexes(es_client, index_name=INDEX_NAME):
+    # Built from the index itself rather than from the embedding stage, so
+    # recipes skipped by an incremental run are included as well.
+    print(f"Exporting local indexes from '{index_name}'...")
+    start_time = time.time()
+    ingredients = IngredientIndexWriter(INGREDIENT_INDEX_PATH)
+    vectors = None
+    fields = ["ingredient_keywords", "n_ingredients"]
+    if LOCAL_VECTOR_INDEX:
+        vectors = VectorIndexWriter(
+            VECTOR_INDEX_DIR,
+            INDEX_SETTINGS["mappings"]["properties"]["text_vector"]["dims"],
+            dtype=LOCAL_VECTOR_DTYPE,
+            ivf_lists=LOCAL_VECTOR_IVF_LISTS,
+        )
+        fields = LOCAL_VECTOR_FIELDS + ["ingredient_keywords", "text_vector"]
+
+    hits = scan(
+        es_client,
+        index=index_name,
+        query={"query": {"match_all": {}}},
+        _source=fields,
+        size=BULK_CHUNK_SIZE,
+    )
+    count = 0
+    for hit in tqdm(hits, unit="docs"):
+        source = hit["_source"]
+        ingredients.add(hit["_id"], source.pop("ingredient_keywords", []), source.get("n_ingredients"))
+        if vectors is not None:
+            vectors.add(hit["_id"], source.pop("text_vector"), source)
+        count += 1
+    ingredients.close()
+    if vectors is not None:
+        vectors.close()
+    report_throughput("Local index export", count, time.time() - start_time)
 
-    es_client.indices.delete(index=INDEX_NAME, ignore_unavailable=True)
-    es_client.indices.create(index=INDEX_NAME, body=index_settings)
-    print(f"Elasticsearch index '{INDEX_NAME}' created")
-    return es_client
 
 def main():
-    print("Starting the indexing process...")
+    parser = argparse.ArgumentParser(description="Index recipes into Elasticsearch")
+    parser.add_argument(
+        "--mode",
+        choices=["incremental", "full"],
+        default=REINDEX_MODE,
+        help="incremental upserts changed recipes in place, full builds a new index and swaps the alias",
+    )
+    args = parser.parse_args()
+
+    print(f"Starting the indexing process ({args.mode})...")
     documents = fetch_documents()
-    # ground_truth = fetch_ground_truth()
+    fetch_ground_truth()
     es_client = setup_elasticsearch()
     model = load_model()
-    index_documents(es_client, documents, model)
+    if args.mode == "full":
+        rebuild_index(es_client, documents, model)
+    else:
+        update_index(es_client, documents, model)
+    export_local_indexes(es_client)
 
     print("Initializing database...")
     init_db()
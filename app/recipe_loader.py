@@ -0,0 +1,91 @@
+import ast
+import gzip
+import json
+
+READ_CHUNK_SIZE = 1 << 20
+WHITESPACE = " \t\r\n"
+
+
+def open_text(path):
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def parse_list(value, separator=None):
+    # List fields (ingredients, steps, tags) hold either a list or its string
+    # representation, e.g. "['salt', 'pepper']". Any other string is a single
+    # item, or is split on separator when one is given.
+    if value is None:
+        return []
+    if isinstance(value, str):
+        if value.startswith("["):
+            try:
+                parsed = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                parsed = None
+            if isinstance(parsed, (list, tuple)):
+                return list(parsed)
+        return value.split(separator) if separator else [value]
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def iter_json_array(f, buffer):
+    # Decodes one array element at a time from a sliding buffer, so only the
+    # current chunk of the file is held in memory.
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in WHITESPACE + ",":
+            pos += 1
+        if pos == len(buffer) or buffer[pos] != "]":
+            try:
+                doc, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(READ_CHUNK_SIZE)
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                eof = not chunk
+                continue
+            yield doc
+            pos = end
+        else:
+            return
+
+
+def iter_json_lines(f, buffer):
+    pending = buffer
+    for line in f:
+        if pending:
+            line = pending + line
+            pending = ""
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def iter_recipes(path):
+    # Accepts a JSON array or JSON Lines file, optionally gzip-compressed.
+    with open_text(path) as f:
+        buffer = ""
+        while True:
+            chunk = f.read(1)
+            if not chunk or chunk not in WHITESPACE:
+                buffer = chunk
+                break
+        if not buffer:
+            return
+        if buffer == "[":
+            yield from iter_json_array(f, "")
+        else:
+            yield from iter_json_lines(f, buffer)
+
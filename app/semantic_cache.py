@@ -0,0 +1,139 @@
+import threading
+import time
+import numpy as np
+from db import save_answer_cache_entry, get_answer_cache_entries, record_answer_cache_hit
+
+ANSWER_FIELDS = [
+    "answer",
+    "relevance",
+    "relevance_explanation",
+    "model_used",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "eval_prompt_tokens",
+    "eval_completion_tokens",
+    "eval_total_tokens",
+    "openai_cost",
+]
+GROW_ROWS = 256
+
+
+class Partition:
+    # Normalized question embeddings of one (model, search type), in a matrix
+    # that grows by doubling; removed rows are filled with the last one.
+
+    def __init__(self, dims):
+        self.matrix = np.empty((GROW_ROWS, dims), dtype=np.float32)
+        self.last_used = np.empty(GROW_ROWS, dtype=np.float64)
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, vector, entry, last_used):
+        row = len(self.entries)
+        if row == len(self.matrix):
+            self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+            self.last_used = np.concatenate([self.last_used, np.empty_like(self.last_used)])
+        self.matrix[row] = vector
+        self.last_used[row] = last_used
+        self.entries.append(entry)
+
+    def remove(self, row):
+        last = len(self.entries) - 1
+        self.matrix[row] = self.matrix[last]
+        self.last_used[row] = self.last_used[last]
+        self.entries[row] = self.entries[last]
+        self.entries.pop()
+
+    def oldest(self):
+        return int(np.argmin(self.last_used[:len(self.entries)]))
+
+    def best_match(self, vector):
+        scores = self.matrix[:len(self.entries)] @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+class SemanticCache:
+    # Answers are persisted in the answer_cache table; lookups run against an
+    # in-process matrix of normalized question embeddings per (model, search
+    # type) holding at most max_entries answers, least recently used evicted.
+    # The cache is an optimization: database errors are logged and count as a miss.
+
+    def __init__(self, threshold, max_entries=10000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._partitions = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._partitions = {}
+        self._size = 0
+        try:
+            for row in get_answer_cache_entries(self.max_entries):
+                entry = {field: row[field] for field in ANSWER_FIELDS}
+                entry["id"] = row["id"]
+                last_used = (row["last_hit_at"] or row["created_at"]).timestamp()
+                self._append((row["model_used"], row["search_type"]), row["embedding"], entry, last_used)
+        except Exception:
+            # Try again on the next lookup.
+            self._partitions = None
+            raise
+
+    def _append(self, key, embedding, entry, last_used):
+        vector = normalize(embedding)
+        partition = self._partitions.get(key)
+        if partition is None:
+            partition = self._partitions[key] = Partition(len(vector))
+        partition.append(vector, entry, last_used)
+        self._size += 1
+        while self._size > self.max_entries:
+            self._evict()
+
+    def _evict(self):
+        key = min(
+            (key for key, partition in self._partitions.items() if len(partition)),
+            key=lambda key: self._partitions[key].last_used[self._partitions[key].oldest()],
+        )
+        partition = self._partitions[key]
+        partition.remove(partition.oldest())
+        self._size -= 1
+
+    def lookup(self, embedding, model_choice, search_type):
+        try:
+            with self._lock:
+                if self._partitions is None:
+                    self._load()
+                partition = self._partitions.get((model_choice, search_type))
+                if partition is None or not len(partition):
+                    return None, 0.0
+                best, similarity = partition.best_match(normalize(embedding))
+                if similarity < self.threshold:
+                    return None, similarity
+                partition.last_used[best] = time.time()
+                entry = partition.entries[best]
+            record_answer_cache_hit(entry["id"])
+        except Exception as e:
+            print(f"Semantic cache lookup failed, treating it as a miss: {e!r}", flush=True)
+            return None, 0.0
+        return entry, similarity
+
+    def add(self, question, embedding, search_type, answer_data):
+        try:
+            entry_id = save_answer_cache_entry(question, embedding, search_type, answer_data)
+        except Exception as e:
+            print(f"Saving answer to the semantic cache failed: {e!r}", flush=True)
+            return
+        entry = {field: answer_data[field] for field in ANSWER_FIELDS}
+        entry["id"] = entry_id
+        with self._lock:
+            if self._partitions is not None:
+                self._append((answer_data["model_used"], search_type), embedding, entry, time.time())
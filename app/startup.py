@@ -0,0 +1,63 @@
+import os
+import resource
+import threading
+import time
+
+# Imported first by assistant.py, so this is roughly when its import began.
+IMPORT_STARTED = time.perf_counter()
+
+_UNSET = object()
+timings = {}
+lazy_resources = []
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # Peak instead of current RSS where /proc is not available.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def mark_imported(module):
+    timings[f"import_{module}"] = time.perf_counter() - IMPORT_STARTED
+
+
+class Lazy:
+    # A client, model or index built by factory on first get(). Concurrent
+    # first calls wait for a single build; set() replaces the value, e.g. with
+    # a stand-in for load tests.
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self._value = _UNSET
+        self._lock = threading.Lock()
+        lazy_resources.append(self)
+
+    @property
+    def loaded(self):
+        return self._value is not _UNSET
+
+    def get(self):
+        if self._value is _UNSET:
+            with self._lock:
+                if self._value is _UNSET:
+                    start_time = time.perf_counter()
+                    value = self.factory()
+                    timings[self.name] = time.perf_counter() - start_time
+                    self._value = value
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+def startup_report():
+    return {
+        "timings_s": {name: round(seconds, 3) for name, seconds in timings.items()},
+        "loaded": [lazy.name for lazy in lazy_resources if lazy.loaded],
+        "rss_mb": round(rss_mb(), 1),
+    }
@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from db import save_trace_spans
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Share of traces kept. The decision is made from the trace id, so the request
+# and its background evaluation are either both kept or both dropped.
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+# Optional exporters, each needs its package installed:
+# opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http, or prometheus-client.
+TRACING_OTLP_ENDPOINT = os.getenv("TRACING_OTLP_ENDPOINT", "")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "recipe-assistant")
+PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "0"))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+_exporters_lock = threading.Lock()
+_otel_tracer = None
+_stage_histogram = None
+
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+def sampled(trace_id):
+    if not TRACING_ENABLED:
+        return False
+    return zlib.crc32(trace_id.encode("utf-8")) / 2 ** 32 < TRACING_SAMPLE_RATE
+
+
+class Trace:
+    # Collects the spans of one request in memory; finish() records the root
+    # span and hands everything to the exporters in one go.
+
+    def __init__(self, trace_id, name, attributes):
+        self.trace_id = trace_id
+        self.name = name
+        self.attributes = attributes
+        self.span_id = new_span_id()
+        self.start_time = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name, start_time, duration, status="ok", parent_id=None, span_id=None, attributes=None):
+        row = self._row(name, start_time, duration, status, parent_id or self.span_id, span_id, attributes)
+        with self._lock:
+            self.spans.append(row)
+
+    def finish(self, status="ok"):
+        root = self._row(self.name, self.start_time, time.time() - self.start_time, status, None, self.span_id,
+                         self.attributes)
+        with self._lock:
+            spans, self.spans = self.spans + [root], []
+        export(spans)
+
+    def _row(self, name, start_time, duration, status, parent_id, span_id, attributes):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": span_id or new_span_id(),
+            "parent_id": parent_id,
+            "name": name,
+            "start_time": start_time,
+            "duration_ms": duration * 1000,
+            "status": status,
+            "attributes": attributes or {},
+        }
+
+
+def start_trace(trace_id=None, name="answer", **attributes):
+    # Returns None when tracing is off or the trace is not sampled; every
+    # helper here accepts that and does nothing.
+    trace_id = trace_id or uuid.uuid4().hex
+    if not sampled(trace_id):
+        return None
+    return Trace(trace_id, name, attributes)
+
+
+@contextmanager
+def activate(active):
+    # Makes active the parent of spans opened inside the block, including in
+    # tasks and asyncio.to_thread calls started from it. None detaches the
+    # block from any trace it would otherwise inherit.
+    trace_token = current_trace.set(active)
+    span_token = current_span.set(active.span_id if active is not None else None)
+    try:
+        yield active
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+
+
+@contextmanager
+def finishing(active):
+    # Finishes active when the block exits, with the status of how it exited.
+    if active is None:
+        yield None
+        return
+    status = "ok"
+    try:
+        yield active
+    except BaseException as e:
+        status = span_status(e)
+        raise
+    finally:
+        active.finish(status)
+
+
+@contextmanager
+def trace(trace_id=None, name="answer", **attributes):
+    active = start_trace(trace_id, name, **attributes)
+    with finishing(active), activate(active):
+        yield active
+
+
+@contextmanager
+def span(name, **attributes):
+    # Times the block as a child of the current span. Yields the attributes
+    # dict so the block can add to it. Not for blocks that yield from a
+    # generator, use timed there.
+    active = current_trace.get()
+    if active is None:
+        yield attributes
+        return
+    parent_id = current_span.get()
+    span_id = new_span_id()
+    token = current_span.set(span_id)
+    start_time = time.time()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException as e:
+        status = span_status(e)
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        active.record(name, start_time, time.time() - start_time, status, parent_id, span_id, attributes)
+
+
+@contextmanager
+def timed(active, name, **attributes):
+    # Like span, but always a child of the root span of active and without
+    # touching the context, so it can wrap yields in a generator.
+    if active is None:
+        yield attributes
+        return
+    start_time = time.time()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException as e:
+        status = span_status(e)
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        active.record(name, start_time, time.time() - start_time, status, attributes=attributes)
+
+
+def span_status(error):
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    return "error"
+
+
+def export(spans):
+    # Tracing must never fail a request, exporter errors are only logged.
+    try:
+        save_trace_spans(spans)
+    except Exception as e:
+        print(f"Saving trace spans failed: {e!r}", flush=True)
+    if TRACING_OTLP_ENDPOINT:
+        try:
+            export_otel(spans)
+        except Exception as e:
+            print(f"OpenTelemetry export failed: {e!r}", flush=True)
+    if PROMETHEUS_PORT:
+        try:
+            export_prometheus(spans)
+        except Exception as e:
+            print(f"Prometheus export failed: {e!r}", flush=True)
+
+
+def get_otel_tracer():
+    global _otel_tracer
+    with _exporters_lock:
+        if _otel_tracer is None:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+            provider = TracerProvider(resource=Resource.create({"service.name": TRACING_SERVICE_NAME}))
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=TRACING_OTLP_ENDPOINT)))
+            _otel_tracer = provider.get_tracer("recipe-assistant")
+        return _otel_tracer
+
+
+def export_otel(spans):
+    # Spans are replayed with their recorded timestamps, parents first.
+    from opentelemetry import trace as otel_trace
+
+    tracer = get_otel_tracer()
+    started = {}
+    for recorded in sorted(spans, key=lambda s: (s["parent_id"] is not None, s["start_time"])):
+        parent = started.get(recorded["parent_id"])
+        context = otel_trace.set_span_in_context(parent) if parent is not None else None
+        attributes = {key: value if isinstance(value, (bool, int, float, str)) else str(value)
+                      for key, value in recorded["attributes"].items() if value is not None}
+        attributes["trace_id"] = recorded["trace_id"]
+        otel_span = tracer.start_span(
+            recorded["name"], context=context, attributes=attributes,
+            start_time=int(recorded["start_time"] * 1e9),
+        )
+        if recorded["status"] != "ok":
+            otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, recorded["status"]))
+        started[recorded["span_id"]] = otel_span
+    for recorded in spans:
+        end_time = recorded["start_time"] + recorded["duration_ms"] / 1000
+        started[recorded["span_id"]].end(end_time=int(end_time * 1e9))
+
+
+def get_stage_histogram():
+    global _stage_histogram
+    with _exporters_lock:
+        if _stage_histogram is None:
+            from prometheus_client import Histogram, start_http_server
+
+            _stage_histogram = Histogram(
+                "recipe_pipeline_stage_seconds",
+                "Duration of answer pipeline stages",
+                ["stage", "status"],
+                buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+            )
+            start_http_server(PROMETHEUS_PORT)
+            print(f"Prometheus metrics served on port {PROMETHEUS_PORT}", flush=True)
+        return _stage_histogram
+
+
+def export_prometheus(spans):
+    histogram = get_stage_histogram()
+    for recorded in spans:
+        histogram.labels(recorded["name"], recorded["status"]).observe(recorded["duration_ms"] / 1000)
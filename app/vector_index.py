@@ -0,0 +1,227 @@
+import json
+import os
+import shutil
+import numpy as np
+from recipe_loader import parse_list
+
+SCORE_BLOCK_ROWS = 65536
+IVF_TRAIN_SAMPLE = 50000
+IVF_ITERATIONS = 20
+
+
+def as_tags(value):
+    return [str(tag).lower() for tag in parse_list(value)]
+
+
+def quantize(vectors):
+    # Symmetric per-row int8 quantization, score = (q @ query) * scale.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def train_ivf(vectors, n_lists, seed=0):
+    # Spherical k-means on a sample of the (normalized) vectors.
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), IVF_TRAIN_SAMPLE), replace=False)]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(IVF_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignment == i]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+
+class VectorIndexWriter:
+    # Appends documents and their vectors to a directory that VectorIndex
+    # memory-maps. Everything is written to a sibling .tmp directory first and
+    # moved into place by close(), so readers never see a half-built index.
+
+    def __init__(self, index_dir, dims, dtype="float32", ivf_lists=0, initial_capacity=1024):
+        self.index_dir = index_dir
+        self.build_dir = index_dir + ".tmp"
+        self.dims = dims
+        self.dtype = dtype
+        self.ivf_lists = ivf_lists
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+        os.makedirs(self.build_dir)
+
+        self.count = 0
+        self.capacity = 0
+        self.vectors = None
+        self.vectors_path = os.path.join(self.build_dir, "vectors.f32")
+        self.docs_file = open(os.path.join(self.build_dir, "documents.jsonl"), "w", encoding="utf-8")
+        open(self.vectors_path, "wb").close()
+        self._resize(initial_capacity)
+
+    def add(self, doc_id, vector, source):
+        if self.count == self.capacity:
+            self._resize(self.capacity * 2)
+        self.vectors[self.count] = vector
+        self.count += 1
+        self.docs_file.write(json.dumps({"_id": doc_id, "_source": source}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.docs_file.close()
+        self._resize(self.count)
+        vectors = self.vectors
+        meta = {"dims": self.dims, "count": self.count, "dtype": self.dtype, "ivf_lists": 0}
+
+        if self.ivf_lists and self.count > self.ivf_lists:
+            centroids = train_ivf(vectors, self.ivf_lists)
+            assignment = np.empty(self.count, dtype=np.int32)
+            for start in range(0, self.count, SCORE_BLOCK_ROWS):
+                block = np.asarray(vectors[start:start + SCORE_BLOCK_ROWS])
+                assignment[start:start + SCORE_BLOCK_ROWS] = np.argmax(block @ centroids.T, axis=1)
+            np.save(os.path.join(self.build_dir, "ivf_centroids.npy"), centroids)
+            np.save(os.path.join(self.build_dir, "ivf_assignment.npy"), assignment)
+            meta["ivf_lists"] = self.ivf_lists
+
+        if self.dtype == "int8":
+            codes = np.memmap(os.path.join(self.build_dir, "vectors.i8"), dtype=np.int8, mode="w+",
+                              shape=(max(self.count, 1), self.dims))
+            scales = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, SCORE_BLOCK_ROWS):
+                block_codes, block_scales = quantize(vectors[start:start + SCORE_BLOCK_ROWS])
+                codes[start:start + SCORE_BLOCK_ROWS] = block_codes
+                scales[start:start + SCORE_BLOCK_ROWS] = block_scales
+            codes.flush()
+            np.save(os.path.join(self.build_dir, "scales.npy"), scales)
+            self.vectors = vectors = None
+            os.remove(self.vectors_path)
+        else:
+            self.vectors.flush()
+            self.vectors = None
+
+        with open(os.path.join(self.build_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+        os.replace(self.build_dir, self.index_dir)
+        print(f"Local vector index '{self.index_dir}' written with {self.count} vectors ({self.dtype})")
+
+    def _resize(self, capacity):
+        capacity = max(capacity, 1)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(capacity * self.dims * 4)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dims))
+        self.capacity = capacity
+
+
+class VectorIndex:
+    # In-process exact (or IVF) cosine search over memory-mapped vectors,
+    # returning hits shaped like Elasticsearch hits.
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.dims = meta["dims"]
+        self.count = meta["count"]
+        self.dtype = meta["dtype"]
+        shape = (max(self.count, 1), self.dims)
+        if self.dtype == "int8":
+            self.vectors = np.memmap(os.path.join(index_dir, "vectors.i8"), dtype=np.int8, mode="r", shape=shape)
+            self.scales = np.load(os.path.join(index_dir, "scales.npy"))
+        else:
+            self.vectors = np.memmap(os.path.join(index_dir, "vectors.f32"), dtype=np.float32, mode="r", shape=shape)
+            self.scales = None
+
+        self.centroids = None
+        self.lists = None
+        if meta["ivf_lists"]:
+            self.centroids = np.load(os.path.join(index_dir, "ivf_centroids.npy"))
+            assignment = np.load(os.path.join(index_dir, "ivf_assignment.npy"))
+            order = np.argsort(assignment, kind="stable")
+            bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+            self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+        self.ids = []
+        self.sources = []
+        with open(os.path.join(index_dir, "documents.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                doc = json.loads(line)
+                self.ids.append(doc["_id"])
+                self.sources.append(doc["_source"])
+        self.n_ingredients = np.array([doc.get("n_ingredients") or 0 for doc in self.sources], dtype=np.int32)
+        self.n_steps = np.array([doc.get("n_steps") or 0 for doc in self.sources], dtype=np.int32)
+        self.tags = [set(as_tags(doc.get("tags"))) for doc in self.sources]
+        self._tag_masks = {}
+
+    def __len__(self):
+        return self.count
+
+    def tag_mask(self, tag):
+        mask = self._tag_masks.get(tag)
+        if mask is None:
+            mask = np.fromiter((tag in tags for tags in self.tags), dtype=bool, count=self.count)
+            self._tag_masks[tag] = mask
+        return mask
+
+    def constraint_mask(self, constraints):
+        # Mirrors constraints.build_es_filters on the in-memory columns.
+        if not constraints:
+            return None
+        mask = np.ones(self.count, dtype=bool)
+        if "max_ingredients" in constraints:
+            mask &= self.n_ingredients <= constraints["max_ingredients"]
+        if "max_steps" in constraints:
+            mask &= self.n_steps <= constraints["max_steps"]
+        for tag in constraints.get("diet_tags", []):
+            mask &= self.tag_mask(tag)
+        if "time_tags" in constraints:
+            mask &= np.logical_or.reduce([self.tag_mask(tag) for tag in constraints["time_tags"]])
+        return mask
+
+    def score_rows(self, query, rows=None):
+        if rows is None:
+            scores = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, SCORE_BLOCK_ROWS):
+                block = self.vectors[start:start + SCORE_BLOCK_ROWS]
+                scores[start:start + SCORE_BLOCK_ROWS] = block @ query if self.scales is None \
+                    else (block.astype(np.float32) @ query) * self.scales[start:start + SCORE_BLOCK_ROWS]
+            return scores
+        block = self.vectors[rows]
+        if self.scales is None:
+            return block @ query
+        return (block.astype(np.float32) @ query) * self.scales[rows]
+
+    def search(self, vector, k=5, constraints=None, nprobe=8):
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        mask = self.constraint_mask(constraints)
+
+        rows = None
+        if self.lists is not None:
+            probe = np.argsort(self.centroids @ query)[::-1][:nprobe]
+            rows = np.concatenate([self.lists[i] for i in probe])
+            if mask is not None:
+                rows = rows[mask[rows]]
+            # Tight constraints can empty the probed lists, fall back to exact search then.
+            if len(rows) < k:
+                rows = None
+        if rows is not None:
+            scores = self.score_rows(query, rows)
+        else:
+            scores = self.score_rows(query)
+            if mask is not None:
+                rows = np.flatnonzero(mask)
+                scores = scores[rows]
+
+        if len(scores) == 0:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        hits = []
+        for i in top:
+            row = int(rows[i]) if rows is not None else int(i)
+            hits.append({"_id": self.ids[row], "_score": float(scores[i]), "_source": self.sources[row]})
+        return hits